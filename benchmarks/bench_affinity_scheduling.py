@@ -0,0 +1,71 @@
+"""
+Compare model swap count and job wait of FIFO and affinity scheduling in TaskQueue.
+
+Simulates a worker running jobs of random model configurations, where each job
+takes a fixed time plus a model loading time when the configuration changes.
+
+Run from the repository root:
+    python benchmarks/bench_affinity_scheduling.py
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fooocusapi.task_queue as task_queue_module
+from fooocusapi.task_queue import TaskQueue, TaskType
+
+
+class FakeClock(object):
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self) -> float:
+        return self.now
+
+
+def simulate(affinity_scheduling: bool, max_wait: float, model_count: int, job_count: int, queue_size: int,
+             job_seconds: float = 10, swap_seconds: float = 8, seed: int = 0):
+    rng = random.Random(seed)
+    clock = FakeClock()
+    task_queue_module.time = clock
+
+    task_queue = TaskQueue(queue_size=queue_size, hisotry_size=job_count)
+    task_queue.affinity_scheduling = affinity_scheduling
+    task_queue.affinity_max_wait_millis = int(max_wait * 1000)
+
+    # Keep the queue full, new jobs arrive as soon as there is room
+    submitted = 0
+    waits = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        while True:
+            while submitted < job_count and task_queue.add_task(TaskType.text_2_img, {}, rng.randrange(model_count)) is not None:
+                submitted += 1
+            swap_count = task_queue.model_swap_count
+            task = task_queue.wait_for_next_task(timeout=0)
+            if task is None:
+                break
+            waits.append(clock.now - task.in_queue_millis / 1000)
+            clock.now += job_seconds + (swap_seconds if task_queue.model_swap_count != swap_count else 0)
+            task_queue.finish_task(task.seq)
+
+    task_queue_module.time = __import__('time')
+    waits.sort()
+    return task_queue.model_swap_count, clock.now - 1000., waits[len(waits) // 2], waits[-1]
+
+
+def main():
+    print(f"{'models':>6} {'queue':>5} {'policy':>14} {'swaps':>6} {'total':>8} {'p50 wait':>9} {'max wait':>9}")
+    for model_count in [2, 4]:
+        for queue_size in [4, 16]:
+            for affinity_scheduling, max_wait in [(False, 0), (True, 60), (True, 600)]:
+                swaps, total, p50, max_wait_seconds = simulate(affinity_scheduling, max_wait, model_count, 500, queue_size)
+                policy = f'affinity {max_wait}s' if affinity_scheduling else 'fifo'
+                print(f"{model_count:>6} {queue_size:>5} {policy:>14} {swaps:>6} {total:>7.0f}s {p50:>8.0f}s {max_wait_seconds:>8.0f}s")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,259 @@
+"""
+Latency and throughput of generation endpoints on CPU, with the stub pipeline of stub_pipeline.py.
+
+Concurrent clients send requests to the API app in process through httpx ASGI transport, jobs run
+in the task schedule thread with a fake diffusion that sleeps per step, and output images are
+encoded and written to a temporary output dir. Also times req_to_params and generation_output
+directly, since they run in every request.
+
+Requires torch (CPU build is fine), fastapi and httpx, but no GPU, model files or Fooocus repository.
+
+Run from the repository root:
+    python benchmarks/bench_api.py
+    python benchmarks/bench_api.py --concurrency 16 --requests 400 --step-seconds 0.005
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List, Tuple
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import numpy as np
+from PIL import Image
+
+import stub_pipeline
+
+
+def setup_stub_app(output_dir: str, queue_size: int, queue_history: int = 1000):
+    """
+    Install stub pipeline, import API app with outputs written to output_dir, and start the task schedule thread
+    """
+    stub_pipeline.install()
+
+    import fooocusapi.file_utils as file_utils
+    file_utils.output_dir = output_dir
+    file_utils.static_serve_base_url = 'http://127.0.0.1:8888/files/'
+
+    import fooocusapi.worker as worker
+    worker.save_log = False
+    worker.task_queue.queue_size = queue_size
+    worker.task_queue.history_size = queue_history
+
+    import fooocusapi.api as api
+    worker.start_task_schedule_thread()
+    return api.app
+
+
+def percentile(sorted_values: List[float], p: float) -> float:
+    if len(sorted_values) == 0:
+        return float('nan')
+    index = min(len(sorted_values) - 1, max(0, int(round(p / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def print_report(rows: List[Tuple[str, List[float], int, float]]):
+    """
+    :param rows: Name, latencies in seconds of succeeded requests, error count and wall time in seconds
+    """
+    print(f"{'name':<28} {'ok':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'req/s':>8}")
+    for name, latencies, errors, wall_time in rows:
+        latencies = sorted(latencies)
+        p50, p95, p99 = (percentile(latencies, p) * 1000 for p in (50, 95, 99))
+        max_latency = latencies[-1] * 1000 if len(latencies) > 0 else float('nan')
+        throughput = len(latencies) / wall_time if wall_time > 0 else 0
+        print(f"{name:<28} {len(latencies):>6} {errors:>6} {p50:>7.1f}ms {p95:>7.1f}ms {p99:>7.1f}ms {max_latency:>7.1f}ms {throughput:>8.2f}")
+
+
+def png_bytes(width: int, height: int, mode: str = 'RGB', seed: int = 0) -> bytes:
+    rng = np.random.default_rng(seed)
+    shape = (height, width) if mode == 'L' else (height, width, 3)
+    buffer = io.BytesIO()
+    Image.fromarray(rng.integers(0, 256, shape, dtype=np.uint8), mode).save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def make_text2img(rng: random.Random, **options) -> dict:
+    return {
+        'prompt': 'a cat sitting on a chair',
+        'aspect_ratios_selection': '1024×1024',
+        'image_seed': rng.randrange(2 ** 31),
+        'advanced_params': None,
+        **options,
+    }
+
+
+async def wait_job(client, job_id: int, poll_interval: float) -> dict:
+    while True:
+        response = await client.get('/v1/generation/query-job', params={'job_id': job_id})
+        response.raise_for_status()
+        job = response.json()
+        if job['job_stage'] in ('SUCCESS', 'ERROR'):
+            return job
+        await asyncio.sleep(poll_interval)
+
+
+def endpoint_requests(image_size: int) -> Dict[str, any]:
+    """
+    Request senders of each benchmarked endpoint, each takes client and rng and raises on failure
+    """
+    input_image = png_bytes(image_size, image_size)
+    input_mask = png_bytes(image_size, image_size, 'L', seed=1)
+
+    async def text_to_image(client, rng):
+        response = await client.post('/v1/generation/text-to-image', json=make_text2img(rng))
+        response.raise_for_status()
+
+    async def text_to_image_base64(client, rng):
+        response = await client.post('/v1/generation/text-to-image', json=make_text2img(rng, require_base64=True))
+        response.raise_for_status()
+
+    async def text_to_image_png(client, rng):
+        response = await client.post('/v1/generation/text-to-image', json=make_text2img(rng), headers={'Accept': 'image/png'})
+        response.raise_for_status()
+
+    async def text_to_image_async(client, rng):
+        response = await client.post('/v1/generation/text-to-image', json=make_text2img(rng, async_process=True))
+        response.raise_for_status()
+        job = await wait_job(client, response.json()['job_id'], 0.01)
+        if job['job_stage'] != 'SUCCESS':
+            raise Exception(f"Job failed: {job['job_status']}")
+
+    async def upscale_vary(client, rng):
+        response = await client.post('/v1/generation/image-upscale-vary',
+                                     data={'uov_method': 'Vary (Subtle)', 'image_seed': rng.randrange(2 ** 31)},
+                                     files={'input_image': ('input.png', input_image, 'image/png')})
+        response.raise_for_status()
+
+    async def inpaint_outpaint(client, rng):
+        response = await client.post('/v1/generation/image-inpait-outpaint',
+                                     data={'prompt': 'a dog', 'image_seed': rng.randrange(2 ** 31)},
+                                     files={'input_image': ('input.png', input_image, 'image/png'),
+                                            'input_mask': ('mask.png', input_mask, 'image/png')})
+        response.raise_for_status()
+
+    async def image_prompt(client, rng):
+        response = await client.post('/v1/generation/image-prompt',
+                                     data={'prompt': 'a bird', 'image_seed': rng.randrange(2 ** 31)},
+                                     files={'cn_img1': ('input.png', input_image, 'image/png')})
+        response.raise_for_status()
+
+    async def job_queue(client, rng):
+        response = await client.get('/v1/generation/job-queue')
+        response.raise_for_status()
+
+    return {
+        'text-to-image': text_to_image,
+        'text-to-image base64': text_to_image_base64,
+        'text-to-image image/png': text_to_image_png,
+        'text-to-image async+poll': text_to_image_async,
+        'image-upscale-vary': upscale_vary,
+        'image-inpait-outpaint': inpaint_outpaint,
+        'image-prompt': image_prompt,
+        'job-queue': job_queue,
+    }
+
+
+async def run_endpoint(client, send, concurrency: int, request_count: int, seed: int) -> Tuple[List[float], int, float]:
+    latencies = []
+    errors = 0
+    remaining = request_count
+
+    async def client_loop(client_index: int):
+        nonlocal errors, remaining
+        rng = random.Random(seed * 1000 + client_index)
+        while remaining > 0:
+            remaining -= 1
+            start = time.perf_counter()
+            try:
+                await send(client, rng)
+                latencies.append(time.perf_counter() - start)
+            except Exception as e:
+                errors += 1
+                if errors == 1:
+                    print(f"First error of {send.__name__}: {e!r}", file=sys.stderr)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client_loop(i) for i in range(concurrency)])
+    return latencies, errors, time.perf_counter() - start
+
+
+async def bench_endpoints(app, args) -> List[Tuple[str, List[float], int, float]]:
+    import httpx
+
+    rows = []
+    senders = endpoint_requests(args.image_size)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://bench', timeout=None) as client:
+        # Warm up, the first job loads the stub models
+        await senders['text-to-image'](client, random.Random(0))
+        for name, send in senders.items():
+            if args.endpoint and name not in args.endpoint:
+                continue
+            rows.append((name, *await run_endpoint(client, send, args.concurrency, args.requests, len(rows))))
+    return rows
+
+
+def bench_functions(rounds: int) -> List[Tuple[str, List[float], int, float]]:
+    from fooocusapi.api_utils import generation_output, req_to_params
+    from fooocusapi.models import Text2ImgRequest
+    from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
+    import fooocusapi.file_utils as file_utils
+
+    rng = random.Random(0)
+    filename = file_utils.save_output_file(np.random.default_rng(0).integers(0, 256, (1024, 1024, 3), dtype=np.uint8))
+    results = [ImageGenerationResult(im=filename, seed=1, finish_reason=GenerationFinishReason.success)]
+
+    def timed(name: str, func) -> Tuple[str, List[float], int, float]:
+        latencies = []
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            for _ in range(rounds):
+                call_start = time.perf_counter()
+                func()
+                latencies.append(time.perf_counter() - call_start)
+        return name, latencies, 0, time.perf_counter() - start
+
+    return [
+        timed('req_to_params', lambda: req_to_params(Text2ImgRequest(**make_text2img(rng)))),
+        timed('generation_output url', lambda: generation_output(results, False, False)),
+        timed('generation_output base64', lambda: generation_output(results, False, True)),
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=8, help='Concurrent clients of each endpoint')
+    parser.add_argument('--requests', type=int, default=64, help='Requests of each endpoint')
+    parser.add_argument('--endpoint', type=str, action='append', default=[], help='Only run named endpoint, can be used multiple times')
+    parser.add_argument('--image-size', type=int, default=512, help='Width and height of uploaded input images')
+    parser.add_argument('--step-seconds', type=float, default=stub_pipeline.step_seconds, help='Seconds of each stub sampling step')
+    parser.add_argument('--function-rounds', type=int, default=200, help='Rounds of direct function benchmarks')
+    args = parser.parse_args()
+
+    stub_pipeline.step_seconds = args.step_seconds
+    with tempfile.TemporaryDirectory() as output_dir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            app = setup_stub_app(output_dir, queue_size=max(args.concurrency * 2, 3))
+
+        print(f"Endpoints, {args.concurrency} concurrent clients, {args.requests} requests each, "
+              f"stub step {args.step_seconds * 1000:.1f}ms:")
+        # Worker logs are dropped
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = asyncio.run(bench_endpoints(app, args))
+        print_report(rows)
+
+        print()
+        print(f"Functions, {args.function_rounds} rounds:")
+        print_report(bench_functions(args.function_rounds))
+
+
+if __name__ == '__main__':
+    main()
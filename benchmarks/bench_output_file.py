@@ -0,0 +1,66 @@
+"""
+Benchmark for reading generated image files back for responses.
+
+Compares the previous decode and re-encode PNG path with passing through the stored
+file bytes, with and without the output file cache.
+
+Run from the repository root:
+    python benchmarks/bench_output_file.py
+"""
+import os
+import sys
+import time
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+import fooocusapi.file_utils as file_utils
+
+
+def reencode_output_file(filename: str) -> bytes:
+    img = Image.open(os.path.join(file_utils.output_dir, filename))
+    output_buffer = BytesIO()
+    img.save(output_buffer, format='PNG')
+    return output_buffer.getvalue()
+
+
+def make_image(width: int, height: int) -> np.ndarray:
+    # Smooth gradient with some noise, compresses roughly like a generated image
+    x = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None, None]
+    noise = np.random.default_rng(0).normal(0, 8, (height, width, 3))
+    return np.clip((x + y) / 2 + noise, 0, 255).astype(np.uint8)
+
+
+def bench(fn, rounds: int) -> float:
+    start = time.perf_counter()
+    for _ in range(rounds):
+        fn()
+    return (time.perf_counter() - start) / rounds
+
+
+def main():
+    rounds = 5
+    print(f"{'size':>10} {'re-encode':>12} {'read file':>12} {'cached':>12}")
+    for width, height in [(1152, 896), (2304, 1792)]:
+        filename = file_utils.save_output_file(make_image(width, height))
+
+        reencode = bench(lambda: reencode_output_file(filename), rounds)
+
+        def read_uncached():
+            file_utils.output_file_cache.remove(filename)
+            file_utils.output_file_to_bytesimg(filename)
+
+        read = bench(read_uncached, rounds)
+        file_utils.output_file_to_bytesimg(filename)
+        cached = bench(lambda: file_utils.output_file_to_bytesimg(filename), rounds)
+        print(f"{f'{width}x{height}':>10} {reencode * 1000:>10.2f}ms {read * 1000:>10.2f}ms {cached * 1000:>10.3f}ms")
+
+        os.remove(os.path.join(file_utils.output_dir, filename))
+
+
+if __name__ == '__main__':
+    main()
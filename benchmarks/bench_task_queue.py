@@ -0,0 +1,59 @@
+"""
+Micro-benchmark for TaskQueue lookup, finish and history eviction cost.
+
+Run from the repository root:
+    python benchmarks/bench_task_queue.py
+"""
+import contextlib
+import io
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
+
+from fooocusapi.task_queue import TaskQueue, TaskType
+
+
+def fill_history(task_queue: TaskQueue, size: int):
+    for _ in range(size):
+        task = task_queue.add_task(TaskType.text_2_img, {})
+        task_queue.finish_task(task.seq)
+
+
+def bench_get_task(task_queue: TaskQueue, seqs: list, rounds: int = 10000) -> float:
+    start = time.perf_counter()
+    for i in range(rounds):
+        task_queue.get_task(seqs[i % len(seqs)], True)
+    return (time.perf_counter() - start) / rounds
+
+
+def bench_finish_task(task_queue: TaskQueue, rounds: int = 1000) -> float:
+    elapsed = 0.
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(rounds):
+            task = task_queue.add_task(TaskType.text_2_img, {})
+            start = time.perf_counter()
+            task_queue.finish_task(task.seq)
+            elapsed += time.perf_counter() - start
+    return elapsed / rounds
+
+
+def main():
+    print(f"{'history':>10} {'get oldest':>12} {'get newest':>12} {'get missing':>12} {'finish+evict':>14}")
+    for history_size in [100, 10000, 100000]:
+        task_queue = TaskQueue(queue_size=history_size, hisotry_size=history_size)
+        fill_history(task_queue, history_size)
+
+        oldest = task_queue.history[0].seq
+        newest = task_queue.history[-1].seq
+        get_oldest = bench_get_task(task_queue, [oldest])
+        get_newest = bench_get_task(task_queue, [newest])
+        get_missing = bench_get_task(task_queue, [-1])
+        finish = bench_finish_task(task_queue)
+        print(f"{history_size:>10} {get_oldest * 1e6:>10.2f}us {get_newest * 1e6:>10.2f}us "
+              f"{get_missing * 1e6:>10.2f}us {finish * 1e6:>12.2f}us")
+
+
+if __name__ == '__main__':
+    main()
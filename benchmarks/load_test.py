@@ -0,0 +1,279 @@
+"""
+Load test driver of generation API, replays request mixes described by scenario files.
+
+A scenario is a JSON file with phases of open loop Poisson arrivals and weighted request kinds:
+
+    {
+        "name": "mixed",
+        "seed": 0,
+        "max_in_flight": 64,
+        "phases": [{"duration": 30, "arrival_rate": 1.0}, {"duration": 60, "arrival_rate": 2.0}],
+        "requests": [
+            {"name": "t2i sync", "weight": 3, "endpoint": "text-to-image"},
+            {"name": "t2i async", "weight": 2, "endpoint": "text-to-image", "async_process": true, "poll_interval": 0.5},
+            {"name": "vary 1024 base64", "weight": 1, "endpoint": "image-upscale-vary", "image_size": [1024, 1024],
+             "require_base64": true, "params": {"uov_method": "Vary (Strong)"}}
+        ]
+    }
+
+Request fields:
+    endpoint: text-to-image, image-upscale-vary, image-inpait-outpaint or image-prompt
+    async_process: Submit async job and poll query-job until finished, latency includes polling
+    poll_interval: Seconds between query-job polls, default 0.5
+    require_base64: Return base64 images instead of URLs
+    accept: Accept header, 'image/png' for image bytes response
+    image_size: Width and height of uploaded input images, default [512, 512]
+    params: Other request fields, merged into JSON body or form
+
+Latency is measured from scheduled arrival time, so requests delayed by max_in_flight are counted as slow
+instead of hidden. See benchmarks/scenarios for examples.
+
+Run against a server, or the stub pipeline of stub_pipeline.py in process:
+    python benchmarks/load_test.py benchmarks/scenarios/mixed.json --url http://127.0.0.1:8888
+    python benchmarks/load_test.py benchmarks/scenarios/ci_stub.json --stub --report-json report.json
+    python benchmarks/load_test.py benchmarks/scenarios/ci_stub.json --stub --baseline report.json --tolerance 0.25
+"""
+import argparse
+import asyncio
+import contextlib
+import io
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+sys.path.insert(0, os.path.abspath(os.path.dirname(__file__)))
+
+import stub_pipeline
+from bench_api import png_bytes, percentile, setup_stub_app, wait_job
+
+
+class RequestStats(object):
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        # Error kind, e.g. HTTP status or exception name, to count
+        self.errors: Dict[str, int] = {}
+
+    def add_error(self, kind: str):
+        self.errors[kind] = self.errors.get(kind, 0) + 1
+
+    def to_dict(self, wall_time: float) -> dict:
+        latencies = sorted(self.latencies)
+        return {
+            'count': len(latencies),
+            'errors': sum(self.errors.values()),
+            'error_kinds': self.errors,
+            'p50_ms': round(percentile(latencies, 50) * 1000, 2) if len(latencies) > 0 else None,
+            'p95_ms': round(percentile(latencies, 95) * 1000, 2) if len(latencies) > 0 else None,
+            'p99_ms': round(percentile(latencies, 99) * 1000, 2) if len(latencies) > 0 else None,
+            'max_ms': round(latencies[-1] * 1000, 2) if len(latencies) > 0 else None,
+            'throughput': round(len(latencies) / wall_time, 3) if wall_time > 0 else 0,
+        }
+
+
+class JobFailed(Exception):
+    pass
+
+
+def load_scenario(path: str) -> dict:
+    with open(path, 'r', encoding='utf-8') as f:
+        scenario = json.load(f)
+    scenario.setdefault('name', os.path.splitext(os.path.basename(path))[0])
+    if len(scenario.get('phases', [])) == 0 or len(scenario.get('requests', [])) == 0:
+        raise ValueError(f"Scenario {path} needs at least one phase and one request")
+    for request in scenario['requests']:
+        if request.get('endpoint') not in ('text-to-image', 'image-upscale-vary', 'image-inpait-outpaint', 'image-prompt'):
+            raise ValueError(f"Unknown endpoint of request {request.get('name')}: {request.get('endpoint')}")
+        request.setdefault('name', request['endpoint'])
+    return scenario
+
+
+def make_sender(request: dict):
+    """
+    Make a coroutine function sending the request kind with client and rng, raises on failure
+    """
+    endpoint = request['endpoint']
+    width, height = request.get('image_size', [512, 512])
+    input_image = png_bytes(width, height) if endpoint != 'text-to-image' else None
+    input_mask = png_bytes(width, height, 'L', seed=1) if endpoint == 'image-inpait-outpaint' else None
+    headers = {'Accept': request['accept']} if 'accept' in request else {}
+    async_process = request.get('async_process', False)
+    poll_interval = request.get('poll_interval', 0.5)
+
+    def make_fields(rng: random.Random) -> dict:
+        fields = {'prompt': 'a cat sitting on a chair', 'image_seed': rng.randrange(2 ** 31)}
+        if async_process:
+            fields['async_process'] = True
+        if request.get('require_base64', False):
+            fields['require_base64'] = True
+        fields.update(request.get('params', {}))
+        return fields
+
+    async def send(client, rng: random.Random):
+        fields = make_fields(rng)
+        if endpoint == 'text-to-image':
+            response = await client.post('/v1/generation/text-to-image', json={'advanced_params': None, **fields}, headers=headers)
+        else:
+            files = {}
+            if endpoint == 'image-upscale-vary':
+                fields.setdefault('uov_method', 'Vary (Subtle)')
+                files['input_image'] = ('input.png', input_image, 'image/png')
+            elif endpoint == 'image-inpait-outpaint':
+                files['input_image'] = ('input.png', input_image, 'image/png')
+                files['input_mask'] = ('mask.png', input_mask, 'image/png')
+            else:
+                files['cn_img1'] = ('input.png', input_image, 'image/png')
+            # Form fields are strings, lists are comma separated
+            data = {k: ','.join(v) if isinstance(v, list) else str(v).lower() if isinstance(v, bool) else str(v)
+                    for k, v in fields.items()}
+            response = await client.post(f'/v1/generation/{endpoint}', data=data, files=files, headers=headers)
+        response.raise_for_status()
+
+        if async_process:
+            job = await wait_job(client, response.json()['job_id'], poll_interval)
+            if job['job_stage'] != 'SUCCESS':
+                raise JobFailed(job['job_status'])
+
+    return send
+
+
+async def run_scenario(client, scenario: dict) -> Dict[str, RequestStats]:
+    rng = random.Random(scenario.get('seed', 0))
+    requests = scenario['requests']
+    senders = [make_sender(r) for r in requests]
+    weights = [r.get('weight', 1) for r in requests]
+    stats = {r['name']: RequestStats(r['name']) for r in requests}
+    in_flight = asyncio.Semaphore(scenario.get('max_in_flight', 64))
+    pending = set()
+
+    async def run_request(index: int, arrival_time: float, request_rng: random.Random):
+        request_stats = stats[requests[index]['name']]
+        async with in_flight:
+            try:
+                await senders[index](client, request_rng)
+                request_stats.latencies.append(time.perf_counter() - arrival_time)
+            except Exception as e:
+                response = getattr(e, 'response', None)
+                request_stats.add_error(f'HTTP {response.status_code}' if response is not None else type(e).__name__)
+
+    start_time = time.perf_counter()
+    phase_start_time = start_time
+    for phase in scenario['phases']:
+        arrival_time = phase_start_time
+        phase_end_time = phase_start_time + phase['duration']
+        while True:
+            arrival_time += rng.expovariate(phase['arrival_rate'])
+            if arrival_time >= phase_end_time:
+                break
+            await asyncio.sleep(max(0., arrival_time - time.perf_counter()))
+            index = rng.choices(range(len(requests)), weights)[0]
+            task = asyncio.create_task(run_request(index, arrival_time, random.Random(rng.random())))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+        phase_start_time = phase_end_time
+
+    if len(pending) > 0:
+        await asyncio.wait(pending)
+    return stats
+
+
+def make_report(scenario: dict, stats: Dict[str, RequestStats], wall_time: float) -> dict:
+    total = RequestStats('total')
+    for s in stats.values():
+        total.latencies += s.latencies
+        for kind, count in s.errors.items():
+            total.errors[kind] = total.errors.get(kind, 0) + count
+    return {
+        'scenario': scenario['name'],
+        'wall_time': round(wall_time, 3),
+        'requests': {name: s.to_dict(wall_time) for name, s in stats.items()},
+        'total': total.to_dict(wall_time),
+    }
+
+
+def print_report(report: dict):
+    print(f"Scenario {report['scenario']}, {report['wall_time']:.1f}s:")
+    print(f"{'request':<28} {'ok':>6} {'errors':>6} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9} {'req/s':>8}")
+    for name, r in list(report['requests'].items()) + [('total', report['total'])]:
+        latencies = ' '.join(f"{'-':>9}" if r[k] is None else f"{r[k]:>7.1f}ms" for k in ('p50_ms', 'p95_ms', 'p99_ms', 'max_ms'))
+        print(f"{name:<28} {r['count']:>6} {r['errors']:>6} {latencies} {r['throughput']:>8.2f}")
+    for name, r in report['requests'].items():
+        if r['errors'] > 0:
+            print(f"Errors of {name}: {', '.join(f'{kind} x{count}' for kind, count in r['error_kinds'].items())}")
+
+
+def compare_baseline(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    """
+    :returns: Regressions of p95 latency or error rate compared with baseline report
+    """
+    regressions = []
+    for name, r in report['requests'].items():
+        b = baseline['requests'].get(name)
+        if b is None:
+            continue
+        if r['p95_ms'] is not None and b['p95_ms'] is not None and r['p95_ms'] > b['p95_ms'] * (1 + tolerance):
+            regressions.append(f"{name}: p95 {r['p95_ms']:.1f}ms > baseline {b['p95_ms']:.1f}ms")
+        error_rate = r['errors'] / max(1, r['count'] + r['errors'])
+        baseline_error_rate = b['errors'] / max(1, b['count'] + b['errors'])
+        if error_rate > baseline_error_rate + tolerance / 10:
+            regressions.append(f"{name}: error rate {error_rate:.1%} > baseline {baseline_error_rate:.1%}")
+    return regressions
+
+
+async def run(args, scenario: dict, app=None) -> dict:
+    import httpx
+
+    if app is not None:
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url='http://stub', timeout=args.timeout)
+    else:
+        client = httpx.AsyncClient(base_url=args.url, timeout=args.timeout,
+                                   limits=httpx.Limits(max_connections=scenario.get('max_in_flight', 64)))
+    async with client:
+        start_time = time.perf_counter()
+        stats = await run_scenario(client, scenario)
+        return make_report(scenario, stats, time.perf_counter() - start_time)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('scenario', type=str, help='Scenario JSON file')
+    parser.add_argument('--url', type=str, default='http://127.0.0.1:8888', help='Base URL of API server')
+    parser.add_argument('--stub', default=False, action='store_true', help='Run against API app in process with stub pipeline instead of a server')
+    parser.add_argument('--step-seconds', type=float, default=stub_pipeline.step_seconds, help='Seconds of each stub sampling step')
+    parser.add_argument('--timeout', type=float, default=600, help='Timeout seconds of each HTTP request')
+    parser.add_argument('--report-json', type=str, default=None, help='Write report to JSON file')
+    parser.add_argument('--baseline', type=str, default=None, help='Exit with 1 if p95 latency or error rate regressed from this JSON report')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed p95 latency increase ratio over baseline, default: 0.2')
+    args = parser.parse_args()
+
+    scenario = load_scenario(args.scenario)
+    with tempfile.TemporaryDirectory() as output_dir:
+        if args.stub:
+            stub_pipeline.step_seconds = args.step_seconds
+            with contextlib.redirect_stdout(io.StringIO()):
+                app = setup_stub_app(output_dir, queue_size=scenario.get('max_in_flight', 64))
+                # Worker logs are dropped
+                report = asyncio.run(run(args, scenario, app))
+        else:
+            report = asyncio.run(run(args, scenario))
+
+    print_report(report)
+    if args.report_json is not None:
+        with open(args.report_json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline, 'r', encoding='utf-8') as f:
+            regressions = compare_baseline(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression of {regression}")
+        if len(regressions) > 0:
+            exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,246 @@
+"""
+Stub Fooocus modules for benchmarks without GPU and Fooocus repository.
+
+install() injects fake `modules.*`, `fcbh.*` and `fooocus_extras.*` modules into sys.modules, so
+fooocusapi.api and fooocusapi.worker can be imported and run jobs on CPU. Diffusion sleeps a
+configurable time per step and returns random images of the requested size, so the measured
+time is spent in the API, task queue, parameter conversion and output file paths.
+
+torch is still required, since fooocusapi.worker uses it directly.
+"""
+import sys
+import time
+import types
+
+import numpy as np
+
+# Seconds slept by the stub pipeline, change before running jobs
+step_seconds = 0.002
+vae_decode_seconds = 0.01
+model_load_seconds = 0.2
+clip_encode_seconds = 0.005
+
+default_model_filenames = ['sd_xl_base_1.0_0.9vae.safetensors', 'sd_xl_refiner_1.0_0.9vae.safetensors']
+default_lora_filenames = ['sd_xl_offset_example-lora_1.0.safetensors']
+
+advanced_parameter_names = [
+    'adm_scaler_positive', 'adm_scaler_negative', 'adm_scaler_end', 'adaptive_cfg', 'sampler_name',
+    'scheduler_name', 'generate_image_grid', 'overwrite_step', 'overwrite_switch', 'overwrite_width', 'overwrite_height',
+    'overwrite_vary_strength', 'overwrite_upscale_strength',
+    'mixing_image_prompt_and_vary_upscale', 'mixing_image_prompt_and_inpaint',
+    'debugging_cn_preprocessor', 'controlnet_softness', 'canny_low_threshold', 'canny_high_threshold', 'inpaint_engine',
+    'refiner_swap_method', 'freeu_enabled', 'freeu_b1', 'freeu_b2', 'freeu_s1', 'freeu_s2',
+]
+
+
+def new_module(name: str, **attributes) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    parent_name, _, child_name = name.rpartition('.')
+    if parent_name != '':
+        setattr(sys.modules[parent_name], child_name, module)
+    return module
+
+
+def install():
+    """
+    Inject stub modules, must be called before importing fooocusapi.api or fooocusapi.worker
+    """
+    if 'modules.default_pipeline' in sys.modules:
+        return
+
+    new_module('modules', __path__=[])
+    new_module('fcbh', __path__=[])
+    new_module('fooocus_extras', __path__=[])
+
+    # fcbh.model_management
+
+    class InterruptProcessingException(Exception):
+        pass
+
+    model_management = new_module('fcbh.model_management', InterruptProcessingException=InterruptProcessingException,
+                                  interrupt_processing=False)
+
+    def interrupt_current_processing(value: bool = True):
+        model_management.interrupt_processing = value
+
+    model_management.interrupt_current_processing = interrupt_current_processing
+
+    # modules.flags, modules.constants, modules.config
+
+    new_module('modules.flags',
+               disabled='Disabled',
+               cn_ip='Image Prompt', cn_canny='PyraCanny', cn_cpds='CPDS',
+               default_parameters={'Image Prompt': (0.5, 0.6), 'PyraCanny': (0.5, 1.0), 'CPDS': (0.5, 1.0)},
+               sampler_list=['euler', 'euler_ancestral', 'heun', 'dpm_2', 'dpm_2_ancestral', 'lms', 'dpm_fast', 'dpm_adaptive',
+                             'dpmpp_2s_ancestral', 'dpmpp_sde', 'dpmpp_sde_gpu', 'dpmpp_2m', 'dpmpp_2m_sde', 'dpmpp_2m_sde_gpu',
+                             'dpmpp_3m_sde', 'dpmpp_3m_sde_gpu', 'ddpm', 'ddim', 'uni_pc', 'uni_pc_bh2'],
+               scheduler_list=['normal', 'karras', 'exponential', 'sgm_uniform', 'simple', 'ddim_uniform'])
+    new_module('modules.constants', MIN_SEED=0, MAX_SEED=2 ** 63 - 1)
+
+    config = new_module('modules.config',
+                        model_filenames=list(default_model_filenames),
+                        lora_filenames=list(default_lora_filenames),
+                        update_all_model_names=lambda: None,
+                        downloading_upscale_model=lambda: 'upscaler.pth',
+                        downloading_inpaint_models=lambda engine: ('inpaint_head.pth', f'inpaint_{engine}.patch'),
+                        downloading_controlnet_canny=lambda: 'control_canny.safetensors',
+                        downloading_controlnet_cpds=lambda: 'control_cpds.safetensors',
+                        downloading_ip_adapters=lambda: ('clip_vision.safetensors', 'ip_negative.safetensors', 'ip_adapter.bin'))
+    sys.modules['modules.path'] = config
+    sys.modules['modules'].path = config
+
+    # modules.advanced_parameters, modules.patch
+
+    advanced_parameters = new_module('modules.advanced_parameters')
+
+    def set_all_advanced_parameters(*args):
+        for name, value in zip(advanced_parameter_names, args):
+            setattr(advanced_parameters, name, value)
+
+    advanced_parameters.set_all_advanced_parameters = set_all_advanced_parameters
+    new_module('modules.patch')
+
+    # modules.sdxl_styles, modules.expansion, modules.private_logger
+
+    new_module('modules.sdxl_styles',
+               fooocus_expansion='Fooocus V2',
+               legal_style_names=['Fooocus V2', 'Fooocus Enhance', 'Fooocus Sharp', 'Fooocus Masterpiece', 'Fooocus Photograph'],
+               apply_style=lambda style, positive: ([f'{positive}, {style}'], [style]),
+               apply_wildcards=lambda text, rng: text)
+    new_module('modules.expansion', safe_str=lambda x: str(x).strip())
+    new_module('modules.private_logger', log=lambda img, dic, single_line_number=3: None)
+
+    # modules.util, modules.upscaler
+
+    def resize_image(im: np.ndarray, width: int, height: int, resize_mode: int = 1) -> np.ndarray:
+        ys = np.linspace(0, im.shape[0] - 1, int(height)).astype(int)
+        xs = np.linspace(0, im.shape[1] - 1, int(width)).astype(int)
+        return im[ys][:, xs]
+
+    def get_shape_ceil(h, w) -> float:
+        return ((h * w) ** 0.5 // 64.0) * 64.0
+
+    def get_image_shape_ceil(im: np.ndarray) -> float:
+        return get_shape_ceil(*im.shape[:2])
+
+    def set_image_shape_ceil(im: np.ndarray, shape_ceil: float) -> np.ndarray:
+        h, w = im.shape[:2]
+        k = shape_ceil / get_image_shape_ceil(im)
+        return resize_image(im, width=int(w * k) // 64 * 64, height=int(h * k) // 64 * 64)
+
+    def hwc3(x: np.ndarray) -> np.ndarray:
+        if x.ndim == 2:
+            x = x[:, :, None]
+        if x.shape[2] == 1:
+            return np.concatenate([x, x, x], axis=2)
+        return x[:, :, :3]
+
+    new_module('modules.util',
+               remove_empty_str=lambda items, default=None: [x for x in items if x != ''] or [default],
+               resize_image=resize_image,
+               HWC3=hwc3,
+               set_image_shape_ceil=set_image_shape_ceil,
+               get_image_shape_ceil=get_image_shape_ceil,
+               get_shape_ceil=get_shape_ceil,
+               resample_image=lambda im, width, height: resize_image(im, int(width), int(height)))
+    new_module('modules.upscaler', perform_upscale=lambda img: img.repeat(2, axis=1).repeat(2, axis=2))
+
+    # modules.core, pixels and latents are numpy arrays instead of torch tensors
+
+    def encode_vae(vae, pixels: np.ndarray, tiled: bool = False) -> dict:
+        B, H, W, C = pixels.shape
+        return {'samples': np.zeros((B, 4, H // 8, W // 8), dtype=np.float32)}
+
+    def encode_vae_inpaint(vae, pixels: np.ndarray, mask: np.ndarray):
+        latent = encode_vae(vae, pixels)['samples']
+        return latent, np.ones((latent.shape[0], 1) + latent.shape[2:], dtype=np.float32)
+
+    new_module('modules.core',
+               numpy_to_pytorch=lambda x: (x.astype(np.float32) / 255.0)[None],
+               pytorch_to_numpy=lambda x: [(y * 255.0).clip(0, 255).astype(np.uint8) for y in x],
+               encode_vae=encode_vae,
+               encode_vae_inpaint=encode_vae_inpaint,
+               apply_controlnet=lambda positive, negative, control_net, image, strength, start, end: (positive, negative),
+               apply_freeu=lambda model, b1, b2, s1, s2: model)
+
+    # modules.inpaint_worker
+
+    class InpaintWorker(object):
+        def __init__(self, image: np.ndarray, mask: np.ndarray, is_outpaint: bool):
+            self.image = image
+            self.mask = mask
+            self.interested_image = image
+            self.interested_fill = image
+            self.interested_mask = mask
+            self.latent = None
+
+        def load_latent(self, latent_fill, latent_inpaint, latent_mask, latent_swap=None, inpaint_head_model_path=None):
+            self.latent = latent_fill
+
+        def post_process(self, img: np.ndarray) -> np.ndarray:
+            return resize_image(img, width=self.image.shape[1], height=self.image.shape[0])
+
+        def visualize_mask_processing(self):
+            return [self.interested_fill, self.interested_mask]
+
+    new_module('modules.inpaint_worker', InpaintWorker=InpaintWorker, current_task=None)
+
+    # fooocus_extras
+
+    new_module('fooocus_extras.preprocessors', canny_pyramid=lambda img: img, cpds=lambda img: img)
+    new_module('fooocus_extras.ip_adapter',
+               load_ip_adapter=lambda clip_vision_path, ip_negative_path, ip_adapter_path: None,
+               preprocess=lambda img: img,
+               patch_model=lambda model, tasks: model)
+
+    # modules.default_pipeline
+
+    class StubModel(object):
+        def __init__(self, name: str):
+            self.name = name
+            self.model = types.SimpleNamespace(diffusion_model=types.SimpleNamespace(in_inpaint=False))
+
+    pipeline = new_module('modules.default_pipeline',
+                          final_clip=None, final_unet=None, final_vae=None, final_refiner_vae=None, final_expansion=None,
+                          loaded_ControlNets={}, model_key=None)
+
+    def refresh_everything(refiner_model_name, base_model_name, loras):
+        model_key = (base_model_name, refiner_model_name, tuple(tuple(l) for l in loras))
+        if model_key != pipeline.model_key:
+            time.sleep(model_load_seconds)
+            pipeline.model_key = model_key
+            pipeline.final_clip = StubModel(base_model_name)
+            pipeline.final_unet = StubModel(base_model_name)
+            pipeline.final_vae = StubModel(base_model_name)
+            pipeline.final_expansion = lambda prompt, seed: f'{prompt}, stub expansion {seed % 1000}'
+
+    def refresh_controlnets(model_paths):
+        pipeline.loaded_ControlNets = {p: StubModel(p) for p in model_paths if p is not None}
+
+    def clip_encode(texts, pool_top_k=1):
+        import torch
+        time.sleep(clip_encode_seconds * len(texts))
+        return [[torch.zeros((1, 77, 2048)), {'pooled_output': torch.zeros((1, 1280))}]]
+
+    def process_diffusion(positive_cond, negative_cond, steps, switch, width, height, image_seed, callback,
+                          sampler_name, scheduler_name, latent=None, denoise=1.0, tiled=False, cfg_scale=7.0,
+                          refiner_swap_method='joint'):
+        model_management.interrupt_processing = False
+        rng = np.random.default_rng(image_seed % (2 ** 32))
+        preview = rng.integers(0, 256, (height // 16, width // 16, 3), dtype=np.uint8)
+        for step in range(steps):
+            time.sleep(step_seconds)
+            if model_management.interrupt_processing:
+                model_management.interrupt_processing = False
+                raise InterruptProcessingException()
+            callback(step, None, None, steps, preview)
+        time.sleep(vae_decode_seconds)
+        return [rng.integers(0, 256, (height, width, 3), dtype=np.uint8)]
+
+    pipeline.refresh_everything = refresh_everything
+    pipeline.refresh_controlnets = refresh_controlnets
+    pipeline.clip_encode = clip_encode
+    pipeline.process_diffusion = process_diffusion
+    pipeline.prepare_text_encoder = lambda async_call=True: None
@@ -1,21 +1,23 @@
-from typing import List, Optional
-from fastapi import Depends, FastAPI, Header, Query, Response, UploadFile
+import asyncio
+import os
+from typing import Dict, List, Optional, Tuple
+from fastapi import Depends, FastAPI, Header, Query, Request, Response, UploadFile
+from fastapi.concurrency import run_in_threadpool
 from fastapi.params import File
+from fastapi.responses import StreamingResponse
 from fastapi.staticfiles import StaticFiles
 import uvicorn
-from fooocusapi.api_utils import generation_output, req_to_params
+from fooocusapi.api_utils import generation_output, is_fixed_seed, params_digest, req_to_params
 import fooocusapi.file_utils as file_utils
-from fooocusapi.models import AllModelNamesResponse, AsyncJobResponse,StopResponse , GeneratedImageResult, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, JobQueueInfo, Text2ImgRequest
-from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
-from fooocusapi.task_queue import TaskType
-from fooocusapi.worker import process_generate, task_queue, process_top
-from concurrent.futures import ThreadPoolExecutor
+import fooocusapi.metrics as metrics
+from fooocusapi.models import AllModelNamesResponse, AsyncJobResponse, CacheStats,StopResponse , GeneratedImageResult, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, JobQueueInfo, OutputFormat, Text2ImgRequest
+from fooocusapi.parameters import GenerationFinishReason, ImageGenerationParams, ImageGenerationResult
+from fooocusapi.result_cache import ResultCache
+from fooocusapi.task_queue import QueueTask, TaskPriority, TaskType
+from fooocusapi.worker import cond_cache, expansion_cache, start_task_schedule_thread, task_queue, process_top
 
 app = FastAPI()
 
-work_executor = ThreadPoolExecutor(
-    max_workers=task_queue.queue_size*2, thread_name_prefix="worker_")
-
 img_generate_responses = {
     "200": {
         "description": "PNG bytes if request's 'Accept' header is 'image/png', otherwise JSON",
@@ -41,7 +43,29 @@ img_generate_responses = {
 }
 
 
-def call_worker(req: Text2ImgRequest, accept: str):
+def get_client_key(request: Request, x_client_key: str | None) -> str | None:
+    if x_client_key is not None and len(x_client_key) > 0:
+        return x_client_key
+    return None if request.client is None else request.client.host
+
+
+# Seconds between checks of sync request client disconnection
+sync_disconnect_check_seconds = 1
+# Attach requests with same parameters and fixed seed to unfinished or recently finished task
+request_coalescing = True
+# Results of sync requests with fixed seed, None for disabled
+result_cache: ResultCache | None = None
+
+
+def cancel_job(job_id: int, detach: bool = False) -> QueueTask | None:
+    return task_queue.cancel_task(job_id, [ImageGenerationResult(im=None, seed=0, finish_reason=GenerationFinishReason.user_cancel)], detach)
+
+
+def add_worker_task(req: Text2ImgRequest, accept: str, client_key: str | None) -> Tuple[QueueTask | List[ImageGenerationResult] | None, ImageGenerationParams, str]:
+    """
+    Add task for the request, or get its results from result cache
+    :returns: The task, cached results or None if queue is full, the params and the cache status
+    """
     task_type = TaskType.text_2_img
     if isinstance(req, ImgUpscaleOrVaryRequest):
         task_type = TaskType.img_uov
@@ -50,33 +74,132 @@ def call_worker(req: Text2ImgRequest, accept: str):
     elif isinstance(req, ImgPromptRequest):
         task_type = TaskType.img_prompt
 
+    if accept == 'image/png' and req.output_format is None:
+        # Response bytes should match the accept header when format not specified
+        req.output_format = OutputFormat.png
+
     params = req_to_params(req)
+    if file_utils.sync_output_in_memory and not req.async_process and (accept == 'image/png' or req.require_base64):
+        params.output_in_memory = True
+
+    # Results of random seed requests are different
+    digest = params_digest(params) if is_fixed_seed(params.image_seed) else None
+    cache_key = None if digest is None else f"{task_type.value}:{digest}"
+
+    # Cached results have no job to query
+    if result_cache is not None and cache_key is not None and not req.async_process:
+        results = result_cache.get(cache_key)
+        if results is not None:
+            return results, params, 'HIT'
+
+    dedup_key = None
+    if request_coalescing and digest is not None and not params.output_in_memory:
+        # In memory results are only for one response
+        dedup_key = (task_type, digest, req.require_base64)
+
+    affinity_key = (params.base_model_name, params.refiner_model_name, tuple(tuple(l) for l in params.loras))
+    # Sync requests are waiting for response, start them before async ones
+    priority = TaskPriority.normal if req.async_process else TaskPriority.high
     queue_task = task_queue.add_task(
-        task_type, {'params': params.__dict__, 'accept': accept, 'require_base64': req.require_base64})
-
-    if queue_task is None:
+        task_type, {'params': params.__dict__, 'accept': accept, 'require_base64': req.require_base64,
+                    'async_process': req.async_process}, affinity_key,
+        priority, client_key, dedup_key)
+
+    if queue_task is None or digest is None:
+        return queue_task, params, 'BYPASS'
+    if queue_task.request_count > 1 or queue_task.is_finished:
+        return queue_task, params, 'COALESCED'
+
+    if result_cache is not None and not params.output_in_memory:
+        def cache_result(task: QueueTask):
+            if task.is_finished and not task.finish_with_error and not task.cancel_requested and task.task_result is not None:
+                result_cache.put(cache_key, task.task_result)
+
+        queue_task.add_listener(cache_result)
+    return queue_task, params, 'MISS'
+
+
+async def wait_for_task_finish(queue_task: QueueTask, request: Request | None = None):
+    """
+    Wait for the task to finish without blocking a thread, cancel it if the client disconnected
+    """
+    loop = asyncio.get_running_loop()
+    task_finished = asyncio.Event()
+
+    def listener(task: QueueTask):
+        if task.is_finished:
+            loop.call_soon_threadsafe(task_finished.set)
+
+    queue_task.add_listener(listener)
+    try:
+        while not queue_task.is_finished:
+            try:
+                await asyncio.wait_for(task_finished.wait(), sync_disconnect_check_seconds)
+            except asyncio.TimeoutError:
+                if request is not None and await request.is_disconnected():
+                    # Nobody is waiting for the result, unless other requests attached to the task
+                    print(f"[Task Queue] Client disconnected, cancel task, seq={queue_task.seq}")
+                    await run_in_threadpool(cancel_job, queue_task.seq, True)
+                    return
+    finally:
+        queue_task.remove_listener(listener)
+
+
+async def call_worker(req: Text2ImgRequest, accept: str, client_key: str | None = None,
+                      request: Request | None = None) -> Tuple[QueueTask | List[ImageGenerationResult], str]:
+    """
+    :returns: The task for async request or results for sync request, and the cache status
+    """
+    # Parameters preparation reads files, and adding task may write the job store
+    queue_task, params, cache_status = await run_in_threadpool(add_worker_task, req, accept, client_key)
+
+    if isinstance(queue_task, list):
+        results = queue_task
+    elif queue_task is None:
         print("[Task Queue] The task queue has reached limit")
         results = [ImageGenerationResult(im=None, seed=0,
                                          finish_reason=GenerationFinishReason.queue_is_full)]
     elif req.async_process:
-        work_executor.submit(process_generate, queue_task, params)
         results = queue_task
     else:
-        results = process_generate(queue_task, params)
+        await wait_for_task_finish(queue_task, request)
+        results = queue_task.task_result if queue_task.task_result is not None else []
+        if params.output_in_memory:
+            # Encoded images are only for this response, don't keep them in task history
+            queue_task.task_result = [ImageGenerationResult(im=None, seed=r.seed, finish_reason=r.finish_reason) for r in results]
+
+    return results, cache_status
+
 
-    return results
+def set_cache_status(output: any, response: Response, cache_status: str) -> any:
+    """
+    Set cache status header to the route response
+    :param output: Returned from the route
+    :param response: The response parameter of the route, only used if output is not a response
+    """
+    (output if isinstance(output, Response) else response).headers['X-Cache-Status'] = cache_status
+    return output
 
 def stop_worker():
     process_top()
 
+app.add_middleware(metrics.HttpRequestMetricsMiddleware)
+
+
+@app.get("/metrics", description="Get metrics in Prometheus text format")
+def get_metrics():
+    return Response(content=metrics.render_metrics(task_queue), media_type="text/plain; version=0.0.4")
+
+
 @app.get("/")
 def home():
     return Response(content='Swagger-UI to: <a href="/docs">/docs</a>', media_type="text/html")
 
 
 @app.post("/v1/generation/text-to-image", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def text2img_generation(req: Text2ImgRequest, accept: str = Header(None),
-                        accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
+async def text2img_generation(req: Text2ImgRequest, request: Request, response: Response, accept: str = Header(None),
+                        accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes"),
+                        x_client_key: str | None = Header(None, description="Client key for fair scheduling between clients, default is client host")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
@@ -87,14 +210,16 @@ def text2img_generation(req: Text2ImgRequest, accept: str = Header(None),
     else:
         streaming_output = False
 
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    results, cache_status = await call_worker(req, accept, get_client_key(request, x_client_key), request)
+    output = await run_in_threadpool(generation_output, results, streaming_output, req.require_base64)
+    return set_cache_status(output, response, cache_status)
 
 
 @app.post("/v1/generation/image-upscale-vary", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_upscale_or_vary(input_image: UploadFile, req: ImgUpscaleOrVaryRequest = Depends(ImgUpscaleOrVaryRequest.as_form),
+async def img_upscale_or_vary(request: Request, response: Response, input_image: UploadFile, req: ImgUpscaleOrVaryRequest = Depends(ImgUpscaleOrVaryRequest.as_form),
                         accept: str = Header(None),
-                        accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
+                        accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes"),
+                        x_client_key: str | None = Header(None, description="Client key for fair scheduling between clients, default is client host")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
@@ -105,14 +230,16 @@ def img_upscale_or_vary(input_image: UploadFile, req: ImgUpscaleOrVaryRequest =
     else:
         streaming_output = False
 
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    results, cache_status = await call_worker(req, accept, get_client_key(request, x_client_key), request)
+    output = await run_in_threadpool(generation_output, results, streaming_output, req.require_base64)
+    return set_cache_status(output, response, cache_status)
 
 
 @app.post("/v1/generation/image-inpait-outpaint", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_inpaint_or_outpaint(input_image: UploadFile, req: ImgInpaintOrOutpaintRequest = Depends(ImgInpaintOrOutpaintRequest.as_form),
+async def img_inpaint_or_outpaint(request: Request, response: Response, input_image: UploadFile, req: ImgInpaintOrOutpaintRequest = Depends(ImgInpaintOrOutpaintRequest.as_form),
                             accept: str = Header(None),
-                            accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
+                            accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes"),
+                            x_client_key: str | None = Header(None, description="Client key for fair scheduling between clients, default is client host")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
@@ -123,15 +250,17 @@ def img_inpaint_or_outpaint(input_image: UploadFile, req: ImgInpaintOrOutpaintRe
     else:
         streaming_output = False
 
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    results, cache_status = await call_worker(req, accept, get_client_key(request, x_client_key), request)
+    output = await run_in_threadpool(generation_output, results, streaming_output, req.require_base64)
+    return set_cache_status(output, response, cache_status)
 
 
 @app.post("/v1/generation/image-prompt", response_model=List[GeneratedImageResult] | AsyncJobResponse, responses=img_generate_responses)
-def img_prompt(cn_img1: Optional[UploadFile] = File(None),
+async def img_prompt(request: Request, response: Response, cn_img1: Optional[UploadFile] = File(None),
                req: ImgPromptRequest = Depends(ImgPromptRequest.as_form),
                accept: str = Header(None),
-               accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes")):
+               accept_query: str | None = Query(None, alias='accept', description="Parameter to overvide 'Accept' header, 'image/png' for output bytes"),
+               x_client_key: str | None = Header(None, description="Client key for fair scheduling between clients, default is client host")):
     if accept_query is not None and len(accept_query) > 0:
         accept = accept_query
 
@@ -142,22 +271,65 @@ def img_prompt(cn_img1: Optional[UploadFile] = File(None),
     else:
         streaming_output = False
 
-    results = call_worker(req, accept)
-    return generation_output(results, streaming_output, req.require_base64)
+    results, cache_status = await call_worker(req, accept, get_client_key(request, x_client_key), request)
+    output = await run_in_threadpool(generation_output, results, streaming_output, req.require_base64)
+    return set_cache_status(output, response, cache_status)
 
 
 @app.get("/v1/generation/query-job", response_model=AsyncJobResponse, description="Query async generation job")
-def query_job(job_id: int):
+def query_job(job_id: int, require_step_preview: bool = False, include_timings: bool = False):
     queue_task = task_queue.get_task(job_id, True)
     if queue_task is None:
         return Response(content="Job not found", status_code=404)
 
-    return generation_output(queue_task, False, False)
+    return generation_output(queue_task, False, False, require_step_preview, include_timings)
+
+
+job_stream_keep_alive_seconds = 15
+
+
+@app.get("/v1/generation/job-stream", description="Stream async generation job progress and result as Server-Sent Events")
+async def job_stream(job_id: int, require_step_preview: bool = False):
+    # Shared task queue reads the file for tasks not mirrored in this process
+    queue_task = await run_in_threadpool(task_queue.get_task, job_id, True)
+    if queue_task is None:
+        return Response(content="Job not found", status_code=404)
+
+    loop = asyncio.get_running_loop()
+    task_changed = asyncio.Event()
+
+    def listener(task: QueueTask):
+        loop.call_soon_threadsafe(task_changed.set)
+
+    async def event_stream():
+        queue_task.add_listener(listener)
+        try:
+            while True:
+                # Only the latest state is sent, changes happened during sending are merged into next event
+                task_changed.clear()
+                is_finished = queue_task.is_finished
+                job = await run_in_threadpool(generation_output, queue_task, False, False, require_step_preview)
+                event = 'result' if is_finished else 'progress'
+                yield f"event: {event}\ndata: {job.model_dump_json()}\n\n"
+                if is_finished:
+                    break
+
+                try:
+                    await asyncio.wait_for(task_changed.wait(), job_stream_keep_alive_seconds)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+        finally:
+            queue_task.remove_listener(listener)
+
+    return StreamingResponse(event_stream(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @app.get("/v1/generation/job-queue", response_model=JobQueueInfo, description="Query job queue info")
 def job_queue():
-    return JobQueueInfo(running_size=len(task_queue.queue), finished_size=len(task_queue.history), last_job_id=task_queue.last_seq)
+    running_size, finished_size, last_seq = task_queue.get_queue_info()
+    return JobQueueInfo(running_size=running_size, finished_size=finished_size, last_job_id=last_seq,
+                        model_swap_count=task_queue.model_swap_count)
 
 
 @app.get("/v1/engines/all-models", response_model=AllModelNamesResponse, description="Get all filenames of base model and lora")
@@ -178,15 +350,42 @@ def all_styles():
     from modules.sdxl_styles import legal_style_names
     return legal_style_names
 
+@app.get("/v1/engines/cache-stats", response_model=Dict[str, CacheStats], description="Get stats of in memory caches")
+def cache_stats():
+    return {
+        'conditioning': cond_cache.stats(),
+        'expansion': expansion_cache.stats(),
+        'output_file': file_utils.output_file_cache.stats(),
+        **({} if result_cache is None else {'result': result_cache.stats()}),
+    }
+
 @app.get("/v1/generation/stop", response_model=StopResponse, description="Job stoping")
-def stop():
-    stop_worker()
+def stop(job_id: int | None = Query(None, description="Cancel the job, remove it if waiting or stop it if running, default is interrupt current processing")):
+    if job_id is None:
+        stop_worker()
+        return StopResponse(msg="success")
+
+    # Identical requests may be attached to the job, it is only canceled when the last of them stopped
+    if cancel_job(job_id, True) is None:
+        return Response(content="Job not found", status_code=404)
     return StopResponse(msg="success")
 
 app.mount("/files", StaticFiles(directory=file_utils.output_dir), name="files")
 
 
+@app.on_event("startup")
+def startup():
+    start_task_schedule_thread()
+
+
 def start_app(args):
+    global request_coalescing, result_cache
+    request_coalescing = not args.disable_request_coalescing
+    if args.result_cache_size > 0:
+        result_cache_file = args.result_cache_file
+        if result_cache_file is None:
+            result_cache_file = os.path.join(os.path.dirname(file_utils.output_dir), 'result_cache.db')
+        result_cache = ResultCache(result_cache_file, args.result_cache_size, args.result_cache_ttl * 3600)
     file_utils.static_serve_base_url = args.base_url + "/files/"
     uvicorn.run("fooocusapi.api:app", host=args.host,
                 port=args.port, log_level=args.log_level)
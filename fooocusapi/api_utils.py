@@ -1,16 +1,17 @@
 import base64
-import io
+import hashlib
 from io import BytesIO
-from typing import List
+from typing import List, Tuple
 
 import numpy as np
 from fastapi import Response, UploadFile
 from PIL import Image
-from fooocusapi.file_utils import get_file_serve_url, output_file_to_base64img, output_file_to_bytesimg
-from fooocusapi.models import AsyncJobResponse, AsyncJobStage, GeneratedImageResult, GenerationFinishReason, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, Text2ImgRequest
+from fooocusapi.file_utils import decode_input_image, decode_input_mask, get_file_serve_url, get_output_media_type, output_file_to_base64img, output_file_to_bytesimg
+from fooocusapi.models import AdvancedParams, AsyncJobResponse, AsyncJobStage, GeneratedImageResult, GenerationFinishReason, ImgInpaintOrOutpaintRequest, ImgPromptRequest, ImgUpscaleOrVaryRequest, Text2ImgRequest
 from fooocusapi.parameters import ImageGenerationParams, ImageGenerationResult, available_aspect_ratios, default_aspect_ratio, inpaint_model_version, default_sampler, default_scheduler, default_base_model_name, default_refiner_model_name
 from fooocusapi.task_queue import QueueTask
 import modules.flags as flags
+import modules.constants as constants
 import modules.config as path
 from modules.sdxl_styles import legal_style_names
 
@@ -38,11 +39,43 @@ def narray_to_bytesimg(narray) -> bytes:
     return byte_data
 
 
-def read_input_image(input_image: UploadFile) -> np.ndarray:
-    input_image_bytes = input_image.file.read()
-    pil_image = Image.open(io.BytesIO(input_image_bytes))
-    image = np.array(pil_image)
-    return image
+def result_to_base64img(result: ImageGenerationResult) -> str | None:
+    if result.im_bytes is not None:
+        return base64.b64encode(result.im_bytes)
+    return output_file_to_base64img(result.im)
+
+
+def read_input_image(input_image: UploadFile, draft_size: Tuple[int, int] | None = None) -> np.ndarray:
+    """
+    Decode input image straight from the uploaded file, see decode_input_image
+    """
+    input_image.file.seek(0)
+    return decode_input_image(input_image.file, draft_size)
+
+
+def read_input_mask(input_mask: UploadFile) -> np.ndarray:
+    """
+    Decode input mask straight from the uploaded file, see decode_input_mask
+    """
+    input_mask.file.seek(0)
+    return decode_input_mask(input_mask.file)
+
+
+def image_prompt_draft_size(cn_type: str, aspect_ratios_selection: str, advanced_params: AdvancedParams | None) -> Tuple[int, int]:
+    """
+    Smallest size the image prompt is resized to by the worker, input images larger than it can be decoded in reduced scale
+    """
+    if cn_type == flags.cn_ip:
+        return 224, 224
+
+    width, height = aspect_ratios_selection.split('×')
+    width, height = int(width), int(height)
+    if advanced_params is not None:
+        if advanced_params.overwrite_width > 0:
+            width = advanced_params.overwrite_width
+        if advanced_params.overwrite_height > 0:
+            height = advanced_params.overwrite_height
+    return width, height
 
 
 def req_to_params(req: Text2ImgRequest) -> ImageGenerationParams:
@@ -93,9 +126,9 @@ def req_to_params(req: Text2ImgRequest) -> ImageGenerationParams:
     if isinstance(req, ImgInpaintOrOutpaintRequest):
         input_image = read_input_image(req.input_image)
         if req.input_mask is not None:
-            input_mask = read_input_image(req.input_mask)
+            input_mask = read_input_mask(req.input_mask)
         else:
-            input_mask = np.zeros(input_image.shape)
+            input_mask = np.zeros(input_image.shape[:2], dtype=np.uint8)
         inpaint_input_image = {
             'image': input_image,
             'mask': input_mask
@@ -105,7 +138,8 @@ def req_to_params(req: Text2ImgRequest) -> ImageGenerationParams:
     if isinstance(req, ImgPromptRequest):
         for img_prompt in req.image_prompts:
             if img_prompt.cn_img is not None:
-                cn_img = read_input_image(img_prompt.cn_img)
+                draft_size = image_prompt_draft_size(img_prompt.cn_type.value, aspect_ratios_selection, req.advanced_params)
+                cn_img = read_input_image(img_prompt.cn_img, draft_size=draft_size)
                 image_prompts.append(
                     (cn_img, img_prompt.cn_stop, img_prompt.cn_weight, img_prompt.cn_type.value))
                 
@@ -155,43 +189,94 @@ def req_to_params(req: Text2ImgRequest) -> ImageGenerationParams:
                                  inpaint_input_image=inpaint_input_image,
                                  image_prompts=image_prompts,
                                  advanced_params=advanced_params,
+                                 output_format=None if req.output_format is None else req.output_format.value,
+                                 output_quality=req.output_quality,
                                  )
 
 
-def generation_output(results: QueueTask | List[ImageGenerationResult], streaming_output: bool, require_base64: bool) -> Response | List[GeneratedImageResult] | AsyncJobResponse:
+def is_fixed_seed(image_seed: int | None) -> bool:
+    """
+    Whether the worker uses the seed as is, seeds out of range are replaced by random seeds like no seed
+    """
+    return image_seed is not None and constants.MIN_SEED <= image_seed <= constants.MAX_SEED
+
+
+def params_digest(params: ImageGenerationParams) -> str:
+    """
+    Canonical digest of generation parameters, input images are digested by their content
+    """
+    digest = hashlib.sha256()
+
+    def update(value: any):
+        if isinstance(value, np.ndarray):
+            digest.update(f"ndarray{value.shape}{value.dtype}".encode())
+            digest.update(np.ascontiguousarray(value).data)
+        elif isinstance(value, dict):
+            digest.update(b'{')
+            for k in sorted(value):
+                update(k)
+                update(value[k])
+            digest.update(b'}')
+        elif isinstance(value, (list, tuple)):
+            digest.update(b'[')
+            for v in value:
+                update(v)
+            digest.update(b']')
+        else:
+            digest.update(repr(value).encode())
+            digest.update(b';')
+
+    update(params.__dict__)
+    return digest.hexdigest()
+
+
+def generation_output(results: QueueTask | List[ImageGenerationResult], streaming_output: bool, require_base64: bool, require_step_preview: bool = False,
+                      include_timings: bool = False) -> Response | List[GeneratedImageResult] | AsyncJobResponse:
     if isinstance(results, QueueTask):
         task = results
         job_stage = AsyncJobStage.running
         job_result = None
+        job_step_preview = None
+        if require_step_preview and not task.is_finished:
+            preview_jpeg = task.get_step_preview_jpeg()
+            if preview_jpeg is not None:
+                job_step_preview = base64.b64encode(preview_jpeg)
+        job_timings = None
+        if include_timings and task.trace is not None:
+            job_timings = task.trace.to_dict()
         if task.start_millis == 0:
             job_stage = AsyncJobStage.waiting
         if task.is_finished:
             if task.finish_with_error:
                 job_stage = AsyncJobStage.error
-            else:
-                if task.task_result != None:
-                    job_stage = AsyncJobStage.success
-                    task_result_require_base64 = False
-                    if 'require_base64' in task.req_param and task.req_param['require_base64']:
-                        task_result_require_base64 = True
-
-                    job_result = generation_output(task.task_result, False, task_result_require_base64)
+            elif task.task_result != None:
+                job_stage = AsyncJobStage.success
+            # Canceled jobs keep results of images finished before cancel
+            if task.task_result != None and (job_stage == AsyncJobStage.success or len(task.task_result) > 0):
+                task_result_require_base64 = False
+                if 'require_base64' in task.req_param and task.req_param['require_base64']:
+                    task_result_require_base64 = True
+
+                job_result = generation_output(task.task_result, False, task_result_require_base64)
         return AsyncJobResponse(job_id=task.seq,
                                 job_type=task.type,
                                 job_stage=job_stage,
                                 job_progess=task.finish_progess,
                                 job_status=task.task_status,
-                                job_result=job_result)
+                                job_step_preview=job_step_preview,
+                                job_result=job_result,
+                                job_timings=job_timings)
 
     if streaming_output:
         if len(results) == 0 or results[0].finish_reason != GenerationFinishReason.success:
             return Response(status_code=500)
+        if results[0].im_bytes is not None:
+            return Response(results[0].im_bytes, media_type=results[0].im_media_type)
         bytes = output_file_to_bytesimg(results[0].im)
-        return Response(bytes, media_type='image/png')
+        return Response(bytes, media_type=get_output_media_type(results[0].im))
     else:
         results = [GeneratedImageResult(
-            base64=output_file_to_base64img(
-                item.im) if require_base64 else None,
+            base64=result_to_base64img(item) if require_base64 else None,
             url=get_file_serve_url(item.im),
             seed=item.seed,
             finish_reason=item.finish_reason) for item in results]
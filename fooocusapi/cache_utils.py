@@ -0,0 +1,123 @@
+from collections import OrderedDict
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Hashable
+
+
+class LRUCache(object):
+    """
+    Thread safe LRU cache bounded by item count and optionally by total size
+    """
+
+    def __init__(self, max_size: int, max_bytes: int = 0, sizeof: Callable[[any], int] | None = None):
+        """
+        :param max_size: Max item count, 0 for disable the cache
+        :param max_bytes: Max total size of items measured by sizeof, 0 for no limit
+        :param sizeof: Function to measure item size, required when max_bytes > 0
+        """
+        self.max_size = max_size
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.items: OrderedDict[Hashable, any] = OrderedDict()
+        self.item_bytes: dict[Hashable, int] = {}
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def get(self, key: Hashable, default: any = None) -> any:
+        with self.lock:
+            if key not in self.items:
+                self.misses += 1
+                return default
+            self.hits += 1
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key: Hashable, value: any):
+        if self.max_size <= 0:
+            return
+
+        size = self.sizeof(value) if self.sizeof is not None else 0
+        if self.max_bytes > 0 and size > self.max_bytes:
+            return
+
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+            self.items[key] = value
+            self.item_bytes[key] = size
+            self.current_bytes += size
+
+            while len(self.items) > self.max_size or (self.max_bytes > 0 and self.current_bytes > self.max_bytes):
+                self._remove(next(iter(self.items)))
+
+    def remove(self, key: Hashable):
+        with self.lock:
+            if key in self.items:
+                self._remove(key)
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.item_bytes.clear()
+            self.current_bytes = 0
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.items),
+            'bytes': self.current_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+    def _remove(self, key: Hashable):
+        del self.items[key]
+        self.current_bytes -= self.item_bytes.pop(key)
+
+
+class SqliteCache(object):
+    """
+    Thread safe persistent string key-value cache in a SQLite file, bounded by item count
+    """
+
+    def __init__(self, path: str, max_size: int):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, access_time REAL NOT NULL)")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS cache_access_time ON cache (access_time)")
+        self.conn.commit()
+
+    def get(self, key: str) -> str | None:
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self.conn.execute("UPDATE cache SET access_time = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return row[0]
+
+    def __len__(self) -> int:
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM cache").fetchone()[0]
+
+    def put(self, key: str, value: str):
+        with self.lock:
+            self.conn.execute("INSERT OR REPLACE INTO cache (key, value, access_time) VALUES (?, ?, ?)", (key, value, time.time()))
+            # Remove least recently used items over size limit
+            self.conn.execute("DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY access_time DESC LIMIT -1 OFFSET ?)", (self.max_size,))
+            self.conn.commit()
+
+    def remove(self, key: str):
+        with self.lock:
+            self.conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+            self.conn.commit()
@@ -1,10 +1,21 @@
 import base64
+from concurrent.futures import ThreadPoolExecutor
 import datetime
 from io import BytesIO
 import os
+import threading
+import time
 import numpy as np
 from PIL import Image
+from typing import Tuple
 import uuid
+from fooocusapi.cache_utils import LRUCache
+
+try:
+    # Optional plugin for AVIF support
+    import pillow_avif
+except ImportError:
+    pass
 
 output_dir = os.path.abspath(os.path.join(
     os.path.dirname(__file__), '..', 'outputs', 'files'))
@@ -12,48 +23,219 @@ os.makedirs(output_dir, exist_ok=True)
 
 static_serve_base_url = 'http://127.0.0.1:8888/files/'
 
+# Keep output images of sync requests which response image bytes directly in memory, without writing files
+sync_output_in_memory = False
+
+# Recently produced output file bytes, saves reading them back from disk
+output_file_cache = LRUCache(max_size=16, max_bytes=128 * 1024 * 1024, sizeof=len)
+
+# Output format name -> (PIL format, file extension, media type)
+output_formats = {
+    'png': ('PNG', 'png', 'image/png'),
+    'jpeg': ('JPEG', 'jpg', 'image/jpeg'),
+    'webp': ('WEBP', 'webp', 'image/webp'),
+    'avif': ('AVIF', 'avif', 'image/avif'),
+}
+
+default_output_format = 'png'
+default_output_quality = 95
+png_compress_level = 6
+
+# Encode and write output files off the generation thread
+output_encode_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="output_encode_")
+
+# Oldest output files are deleted when output dir is larger than it, 0 for no limit
+output_dir_max_bytes = 0
+# Output dir is trimmed at most once per interval after saving output files, in its own thread
+trim_interval_seconds = 60
+last_trim_time = 0.
+trim_thread: threading.Thread | None = None
+
+
+def is_output_format_supported(output_format: str) -> bool:
+    if output_format not in output_formats:
+        return False
+    Image.init()
+    return output_formats[output_format][0] in Image.SAVE
+
+
+def encode_output_image(img: np.ndarray, output_format: str, output_quality: int | None = None) -> bytes:
+    pil_format = output_formats[output_format][0]
+    quality = default_output_quality if output_quality is None else output_quality
+
+    output_buffer = BytesIO()
+    if pil_format == 'PNG':
+        Image.fromarray(img).save(output_buffer, format=pil_format, compress_level=png_compress_level)
+    else:
+        Image.fromarray(img).convert('RGB').save(output_buffer, format=pil_format, quality=quality)
+    return output_buffer.getvalue()
+
+
+def resolve_output_format(output_format: str | None) -> str:
+    if output_format is None:
+        output_format = default_output_format
+    if not is_output_format_supported(output_format):
+        print(f"[Warning] Unsupported output format: {output_format}, using png")
+        output_format = 'png'
+    return output_format
+
+
+def save_output_file(img: np.ndarray, output_format: str | None = None, output_quality: int | None = None) -> str:
+    output_format = resolve_output_format(output_format)
 
-def save_output_file(img: np.ndarray) -> str:
     current_time = datetime.datetime.now()
     date_string = current_time.strftime("%Y-%m-%d")
 
-    filename = os.path.join(date_string, str(uuid.uuid4()) + '.png')
+    filename = os.path.join(date_string, str(uuid.uuid4()) + '.' + output_formats[output_format][1])
     file_path = os.path.join(output_dir, filename)
 
+    byte_data = encode_output_image(img, output_format, output_quality)
+
     os.makedirs(os.path.dirname(file_path), exist_ok=True)
-    Image.fromarray(img).save(file_path)
+    with open(file_path, 'wb') as f:
+        f.write(byte_data)
+    output_file_cache.put(filename, byte_data)
+    trim_output_dir_async()
     return filename
 
 
-def output_file_to_base64img(filename: str | None) -> str | None:
-    if filename is None:
-        return None
-    file_path = os.path.join(output_dir, filename)
-    if not os.path.exists(file_path) or not os.path.isfile(file_path):
-        return None
+def encode_output_bytes(img: np.ndarray, output_format: str | None = None, output_quality: int | None = None) -> Tuple[bytes, str]:
+    """
+    Encode output image in memory without writing file
+    :returns: The encoded bytes and its media type
+    """
+    output_format = resolve_output_format(output_format)
+    return encode_output_image(img, output_format, output_quality), output_formats[output_format][2]
+
+
+def get_output_media_type(filename: str) -> str:
+    extension = os.path.splitext(filename)[1][1:].lower()
+    for _, file_extension, media_type in output_formats.values():
+        if file_extension == extension:
+            return media_type
+    return 'application/octet-stream'
+
+
+def decode_input_image(fp: any, draft_size: Tuple[int, int] | None = None) -> np.ndarray:
+    """
+    Decode input image once from file path or file object, the returned array is read only
+    :param draft_size: Let JPEG decoder reduce scale when the image is larger, not smaller than the size
+    """
+    pil_image = Image.open(fp)
+    if draft_size is not None:
+        pil_image.draft(None, draft_size)
+    if pil_image.mode not in ('RGB', 'RGBA', 'L'):
+        pil_image = pil_image.convert('RGB')
+    return np.asarray(pil_image)
 
-    img = Image.open(file_path)
+
+def decode_input_mask(fp: any) -> np.ndarray:
+    """
+    Decode input mask from file path or file object to single channel, the returned array is read only.
+    The first channel of color masks is used, e.g. red of RGB masks, not converted to luminance.
+    """
+    pil_image = Image.open(fp)
+    if pil_image.mode == 'P':
+        pil_image = pil_image.convert('RGBA' if 'transparency' in pil_image.info else 'RGB')
+    if len(pil_image.getbands()) > 1:
+        pil_image = pil_image.getchannel(0)
+    elif pil_image.mode != 'L':
+        pil_image = pil_image.convert('L')
+    return np.asarray(pil_image)
+
+
+def narray_to_jpeg_bytes(img: np.ndarray, quality: int = 75) -> bytes:
     output_buffer = BytesIO()
-    img.save(output_buffer, format='PNG')
-    byte_data = output_buffer.getvalue()
-    base64_str = base64.b64encode(byte_data)
-    return base64_str
+    Image.fromarray(img).convert('RGB').save(output_buffer, format='JPEG', quality=quality)
+    return output_buffer.getvalue()
 
 
-def output_file_to_bytesimg(filename: str | None) -> bytes | None:
+def output_files_exist(results: list) -> bool:
+    """
+    Check output files of results are not deleted, e.g. by output dir trimming
+    """
+    return all(r.im is None or os.path.isfile(os.path.join(output_dir, r.im)) for r in results)
+
+
+def read_output_file(filename: str | None) -> bytes | None:
     if filename is None:
         return None
+    byte_data = output_file_cache.get(filename)
+    if byte_data is not None:
+        return byte_data
+
     file_path = os.path.join(output_dir, filename)
     if not os.path.exists(file_path) or not os.path.isfile(file_path):
         return None
 
-    img = Image.open(file_path)
-    output_buffer = BytesIO()
-    img.save(output_buffer, format='PNG')
-    byte_data = output_buffer.getvalue()
+    with open(file_path, 'rb') as f:
+        byte_data = f.read()
+    output_file_cache.put(filename, byte_data)
     return byte_data
 
 
+def trim_output_dir(max_bytes: int) -> int:
+    """
+    Delete oldest output files until total size of output dir is under max_bytes
+    :returns: Count of deleted files
+    """
+    files = []
+    total_bytes = 0
+    for dir_path, _, filenames in os.walk(output_dir):
+        for name in filenames:
+            file_path = os.path.join(dir_path, name)
+            try:
+                stat = os.stat(file_path)
+            except OSError:
+                continue
+            files.append((stat.st_mtime, stat.st_size, file_path))
+            total_bytes += stat.st_size
+
+    deleted_count = 0
+    files.sort()
+    for _, size, file_path in files:
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(file_path)
+        except OSError:
+            continue
+        total_bytes -= size
+        deleted_count += 1
+        output_file_cache.remove(os.path.relpath(file_path, output_dir))
+    return deleted_count
+
+
+def trim_output_dir_async():
+    global last_trim_time, trim_thread
+    now = time.time()
+    if output_dir_max_bytes <= 0 or now - last_trim_time < trim_interval_seconds:
+        return
+    if trim_thread is not None and trim_thread.is_alive():
+        return
+    last_trim_time = now
+
+    def trim():
+        deleted_count = trim_output_dir(output_dir_max_bytes)
+        if deleted_count > 0:
+            print(f"[Output Dir] Over size limit, delete {deleted_count} oldest files")
+
+    trim_thread = threading.Thread(target=trim, name="output_dir_trim", daemon=True)
+    trim_thread.start()
+
+
+def output_file_to_base64img(filename: str | None) -> str | None:
+    byte_data = read_output_file(filename)
+    if byte_data is None:
+        return None
+    base64_str = base64.b64encode(byte_data)
+    return base64_str
+
+
+def output_file_to_bytesimg(filename: str | None) -> bytes | None:
+    return read_output_file(filename)
+
+
 def get_file_serve_url(filename: str | None) -> str | None:
     if filename is None:
         return None
@@ -0,0 +1,173 @@
+import atexit
+import json
+import os
+import pickle
+import queue
+import sqlite3
+import threading
+from typing import List, Tuple
+
+from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
+from fooocusapi.task_queue import QueueTask, TaskPriority, TaskQueue, TaskType
+
+
+class JobStore(object):
+    """
+    Persistence backend of TaskQueue, records job params, state transitions and results
+    """
+
+    def add_job(self, task: QueueTask):
+        pass
+
+    def start_job(self, task: QueueTask):
+        pass
+
+    def finish_job(self, task: QueueTask):
+        pass
+
+    def load_jobs(self) -> Tuple[List[QueueTask], List[QueueTask]]:
+        """
+        Load jobs saved before
+        :returns: Unfinished jobs and finished jobs, both ordered by seq
+        """
+        return [], []
+
+    def close(self):
+        pass
+
+
+def results_to_json(results: List[ImageGenerationResult] | None) -> str | None:
+    if results is None:
+        return None
+    # In memory images are not persisted, only the file references
+    return json.dumps([{'im': r.im, 'seed': r.seed, 'finish_reason': r.finish_reason.value} for r in results])
+
+
+def results_from_json(results_json: str | None) -> List[ImageGenerationResult] | None:
+    if results_json is None:
+        return None
+    return [ImageGenerationResult(im=r['im'], seed=r['seed'], finish_reason=GenerationFinishReason(r['finish_reason']))
+            for r in json.loads(results_json)]
+
+
+class SqliteJobStore(JobStore):
+    """
+    Job store in a SQLite file in WAL mode, writes are batched in a background thread
+    """
+
+    def __init__(self, path: str, history_size: int):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.history_size = history_size
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            seq INTEGER PRIMARY KEY,
+            type TEXT NOT NULL,
+            req_param BLOB NOT NULL,
+            affinity_key BLOB,
+            priority INTEGER NOT NULL,
+            client_key TEXT,
+            state TEXT NOT NULL,
+            in_queue_millis INTEGER NOT NULL,
+            start_millis INTEGER NOT NULL DEFAULT 0,
+            finish_millis INTEGER NOT NULL DEFAULT 0,
+            finish_with_error INTEGER NOT NULL DEFAULT 0,
+            error_message TEXT,
+            task_result TEXT
+        )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, seq)")
+        self.conn.commit()
+
+        self.pending_writes = queue.Queue()
+        self.writer_thread = threading.Thread(target=self.write_loop, name="job_store_writer", daemon=True)
+        self.writer_thread.start()
+        atexit.register(self.close)
+
+    def add_job(self, task: QueueTask):
+        # Params are serialized now since the worker may change them later
+        self.pending_writes.put(("INSERT OR REPLACE INTO jobs (seq, type, req_param, affinity_key, priority, client_key, state, in_queue_millis) "
+                                 "VALUES (?, ?, ?, ?, ?, ?, 'waiting', ?)",
+                                 (task.seq, task.type.value, pickle.dumps(task.req_param), pickle.dumps(task.affinity_key),
+                                  int(task.priority), task.client_key, task.in_queue_millis)))
+
+    def start_job(self, task: QueueTask):
+        self.pending_writes.put(("UPDATE jobs SET state = 'running', start_millis = ? WHERE seq = ?",
+                                 (task.start_millis, task.seq)))
+
+    def finish_job(self, task: QueueTask):
+        self.pending_writes.put(("UPDATE jobs SET state = 'finished', finish_millis = ?, finish_with_error = ?, error_message = ?, task_result = ? WHERE seq = ?",
+                                 (task.finish_millis, int(task.finish_with_error), task.error_message,
+                                  results_to_json(task.task_result), task.seq)))
+        self.pending_writes.put(("DELETE FROM jobs WHERE state = 'finished' AND seq NOT IN "
+                                 "(SELECT seq FROM jobs WHERE state = 'finished' ORDER BY seq DESC LIMIT ?)",
+                                 (self.history_size,)))
+
+    def write_loop(self):
+        while True:
+            writes = [self.pending_writes.get()]
+            while not self.pending_writes.empty() and len(writes) < 256:
+                writes.append(self.pending_writes.get_nowait())
+
+            try:
+                with self.conn:
+                    for write in writes:
+                        if write is None:
+                            continue
+                        self.conn.execute(*write)
+            except Exception as e:
+                print('Job store write error:', e)
+
+            for _ in writes:
+                self.pending_writes.task_done()
+            if None in writes:
+                return
+
+    def load_jobs(self) -> Tuple[List[QueueTask], List[QueueTask]]:
+        unfinished_jobs = []
+        finished_jobs = []
+        columns = "seq, type, req_param, affinity_key, priority, client_key, state, in_queue_millis, start_millis, finish_millis, finish_with_error, error_message, task_result"
+        rows = self.conn.execute(f"SELECT {columns} FROM jobs WHERE state != 'finished' ORDER BY seq").fetchall()
+        rows += self.conn.execute(f"SELECT {columns} FROM (SELECT {columns} FROM jobs WHERE state = 'finished' ORDER BY seq DESC LIMIT ?) ORDER BY seq",
+                                  (self.history_size,)).fetchall()
+        for seq, type, req_param, affinity_key, priority, client_key, state, in_queue_millis, start_millis, finish_millis, \
+                finish_with_error, error_message, task_result in rows:
+            try:
+                task = QueueTask(seq=seq, type=TaskType(type), req_param=pickle.loads(req_param), in_queue_millis=in_queue_millis,
+                                 affinity_key=pickle.loads(affinity_key), priority=TaskPriority(priority), client_key=client_key)
+            except Exception as e:
+                print(f"[Job Store] Skip broken job, seq={seq}: {e}")
+                continue
+
+            if state == 'finished':
+                task.start_millis = start_millis
+                task.finish_millis = finish_millis
+                task.set_result(results_from_json(task_result), bool(finish_with_error), error_message)
+                task.is_finished = True
+                finished_jobs.append(task)
+            else:
+                unfinished_jobs.append(task)
+        return unfinished_jobs, finished_jobs
+
+    def close(self):
+        if self.writer_thread.is_alive():
+            self.pending_writes.put(None)
+            self.writer_thread.join()
+
+
+def restore_jobs(task_queue: TaskQueue, job_store: JobStore):
+    """
+    Restore jobs saved in job store to task queue, and record later jobs to it.
+    Unfinished async jobs are queued again, unfinished sync jobs are finished with error since nobody is waiting for them.
+    """
+    unfinished_jobs, finished_jobs = job_store.load_jobs()
+    task_queue.restore_tasks(unfinished_jobs, finished_jobs)
+    task_queue.job_store = job_store
+
+    for task in unfinished_jobs:
+        if task.req_param.get('async_process', False):
+            job_store.add_job(task)
+        else:
+            task.set_result([], True, 'Server restarted before job finished')
+            task_queue.finish_task(task.seq)
+    print(f"[Job Store] Restored {len(unfinished_jobs)} unfinished jobs and {len(finished_jobs)} finished jobs")
@@ -0,0 +1,145 @@
+import bisect
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from fooocusapi.task_queue import TaskQueue, TaskType
+
+
+class Histogram(object):
+    """
+    Thread safe histogram with fixed buckets, rendered in Prometheus text format
+    """
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...], label_names: Tuple[str, ...] = ('task_type',)):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label_names = label_names
+        # Label values -> (count of each bucket, sum, count)
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], float, int]] = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value: float, *label_values: str):
+        with self.lock:
+            bucket_counts, total, count = self.values.get(label_values, ([0] * len(self.buckets), 0., 0))
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                bucket_counts[index] += 1
+            self.values[label_values] = (bucket_counts, total + value, count + 1)
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for label_values, (bucket_counts, total, count) in sorted(self.values.items()):
+                labels = format_labels(self.label_names, label_values)
+                cumulative = 0
+                for bound, bucket_count in zip(self.buckets, bucket_counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{{{labels}{',' if labels else ''}le=\"{bound}\"}} {cumulative}")
+                lines.append(f"{self.name}_bucket{{{labels}{',' if labels else ''}le=\"+Inf\"}} {count}")
+                lines.append(render_sample(f"{self.name}_sum", total, self.label_names, label_values))
+                lines.append(render_sample(f"{self.name}_count", count, self.label_names, label_values))
+        return lines
+
+
+def format_labels(label_names: Tuple[str, ...], label_values: Tuple[str, ...]) -> str:
+    return ','.join(f'{name}="{escape_label_value(value)}"' for name, value in zip(label_names, label_values))
+
+
+def escape_label_value(value: any) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def render_sample(name: str, value: float, label_names: Tuple[str, ...] = (), label_values: Tuple[str, ...] = ()) -> str:
+    labels = format_labels(label_names, label_values)
+    return f"{name}{{{labels}}} {value}" if labels else f"{name} {value}"
+
+
+stage_buckets = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+step_buckets = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+queue_wait_seconds = Histogram('fooocus_queue_wait_seconds', 'Seconds a job waited in queue before started', stage_buckets)
+preparation_seconds = Histogram('fooocus_preparation_seconds', 'Seconds of preparing a job before sampling, include model loading and prompt encoding', stage_buckets)
+sampling_step_seconds = Histogram('fooocus_sampling_step_seconds', 'Seconds of each sampling step', step_buckets)
+vae_decode_seconds = Histogram('fooocus_vae_decode_seconds', 'Seconds from the last sampling step to decoded image', step_buckets + (10,))
+output_encode_seconds = Histogram('fooocus_output_encode_seconds', 'Seconds of encoding and saving an output image', step_buckets)
+http_request_seconds = Histogram('fooocus_http_request_seconds', 'Seconds of handling HTTP requests', stage_buckets, ('method', 'path', 'status'))
+
+histograms = [queue_wait_seconds, preparation_seconds, sampling_step_seconds, vae_decode_seconds, output_encode_seconds, http_request_seconds]
+
+
+class HttpRequestMetricsMiddleware(object):
+    """
+    Pure ASGI middleware observing seconds until response started, labeled by route path template.
+    Unlike BaseHTTPMiddleware, receive is passed through, so routes can still see client disconnect.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        start_time = time.perf_counter()
+        response_started = False
+
+        def observe(status_code: int):
+            # Route path template is set to scope by router, not to make a label for every job id or file
+            route = scope.get('route')
+            path = route.path if route is not None else 'unmatched'
+            http_request_seconds.observe(time.perf_counter() - start_time, scope['method'], path, str(status_code))
+
+        async def send_observed(message):
+            nonlocal response_started
+            if message['type'] == 'http.response.start' and not response_started:
+                response_started = True
+                observe(message['status'])
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_observed)
+        except Exception:
+            if not response_started:
+                observe(500)
+            raise
+
+
+def render_metrics(task_queue: TaskQueue) -> str:
+    """
+    Render all metrics in Prometheus text format, with gauges of task queue and torch memory
+    """
+    lines = []
+    for histogram in histograms:
+        lines += histogram.render()
+
+    with task_queue.condition:
+        queue_tasks = list(task_queue.queue)
+        history_size = len(task_queue.history)
+        model_swap_count = task_queue.model_swap_count
+
+    lines += ["# HELP fooocus_queue_depth Unfinished jobs in queue", "# TYPE fooocus_queue_depth gauge"]
+    for task_type in TaskType:
+        for state in ['waiting', 'running']:
+            count = len([t for t in queue_tasks if t.type == task_type and (t.start_millis == 0) == (state == 'waiting')])
+            lines.append(render_sample('fooocus_queue_depth', count, ('task_type', 'state'), (task_type.name, state)))
+    lines += ["# HELP fooocus_history_size Finished jobs in history", "# TYPE fooocus_history_size gauge",
+              render_sample('fooocus_history_size', history_size)]
+    lines += ["# HELP fooocus_model_swaps_total Times the models of started jobs changed", "# TYPE fooocus_model_swaps_total counter",
+              render_sample('fooocus_model_swaps_total', model_swap_count)]
+
+    try:
+        import torch
+        if torch.cuda.is_available():
+            lines += ["# HELP fooocus_torch_memory_allocated_bytes Torch allocated memory of device", "# TYPE fooocus_torch_memory_allocated_bytes gauge"]
+            lines += [render_sample('fooocus_torch_memory_allocated_bytes', torch.cuda.memory_allocated(i), ('device',), (str(i),))
+                      for i in range(torch.cuda.device_count())]
+            lines += ["# HELP fooocus_torch_memory_reserved_bytes Torch reserved memory of device", "# TYPE fooocus_torch_memory_reserved_bytes gauge"]
+            lines += [render_sample('fooocus_torch_memory_reserved_bytes', torch.cuda.memory_reserved(i), ('device',), (str(i),))
+                      for i in range(torch.cuda.device_count())]
+    except ImportError:
+        pass
+
+    return '\n'.join(lines) + '\n'
@@ -41,6 +41,13 @@ class OutpaintExpansion(str, Enum):
     bottom = 'Bottom'
 
 
+class OutputFormat(str, Enum):
+    png = 'png'
+    jpeg = 'jpeg'
+    webp = 'webp'
+    avif = 'avif'
+
+
 class ControlNetType(str, Enum):
     cn_ip = 'Image Prompt'
     cn_canny = 'PyraCanny'
@@ -101,6 +108,8 @@ class Text2ImgRequest(BaseModel):
         Lora(model_name=default_lora_name, weight=default_lora_weight)])
     advanced_params: AdvancedParams | None = Field(deafult=None, description="Advanced parameters")
     require_base64: bool = Field(default=False, description="Return base64 data of generated image")
+    output_format: OutputFormat | None = Field(default=None, description="Output image format, null for server default")
+    output_quality: int | None = Field(default=None, ge=1, le=100, description="Output image quality for jpeg, webp and avif, null for server default")
     async_process: bool = Field(default=False, description="Set to true will run async and return job info for retrieve generataion result later")
 
 
@@ -137,6 +146,8 @@ class ImgUpscaleOrVaryRequest(Text2ImgRequest):
                 w5: float = Form(default=default_lora_weight, ge=-2, le=2),
                 advanced_params: str| None = Form(default=None, description="Advanced parameters in JSON"),
                 require_base64: bool = Form(default=False, description="Return base64 data of generated image"),
+                output_format: OutputFormat | None = Form(default=None, description="Output image format, null for server default"),
+                output_quality: int | None = Form(default=None, ge=1, le=100, description="Output image quality for jpeg, webp and avif, null for server default"),
                 async_process: bool = Form(default=False, description="Set to true will run async and return job info for retrieve generataion result later"),
                 ):
         style_selection_arr: List[str] = []
@@ -165,7 +176,8 @@ class ImgUpscaleOrVaryRequest(Text2ImgRequest):
                    performance_selection=performance_selection, aspect_ratios_selection=aspect_ratios_selection,
                    image_number=image_number, image_seed=image_seed, sharpness=sharpness, guidance_scale=guidance_scale,
                    base_model_name=base_model_name, refiner_model_name=refiner_model_name, refiner_switch=refiner_switch,
-                   loras=loras, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process)
+                   loras=loras, advanced_params=advanced_params_obj, require_base64=require_base64,
+                   output_format=output_format, output_quality=output_quality, async_process=async_process)
 
 
 class ImgInpaintOrOutpaintRequest(Text2ImgRequest):
@@ -205,6 +217,8 @@ class ImgInpaintOrOutpaintRequest(Text2ImgRequest):
                 w5: float = Form(default=default_lora_weight, ge=-2, le=2),
                 advanced_params: str| None = Form(default=None, description="Advanced parameters in JSON"),
                 require_base64: bool = Form(default=False, description="Return base64 data of generated image"),
+                output_format: OutputFormat | None = Form(default=None, description="Output image format, null for server default"),
+                output_quality: int | None = Form(default=None, ge=1, le=100, description="Output image quality for jpeg, webp and avif, null for server default"),
                 async_process: bool = Form(default=False, description="Set to true will run async and return job info for retrieve generataion result later"),
                 ):
 
@@ -249,7 +263,8 @@ class ImgInpaintOrOutpaintRequest(Text2ImgRequest):
                    performance_selection=performance_selection, aspect_ratios_selection=aspect_ratios_selection,
                    image_number=image_number, image_seed=image_seed, sharpness=sharpness, guidance_scale=guidance_scale,
                    base_model_name=base_model_name, refiner_model_name=refiner_model_name, refiner_switch=refiner_switch,
-                   loras=loras, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process)
+                   loras=loras, advanced_params=advanced_params_obj, require_base64=require_base64,
+                   output_format=output_format, output_quality=output_quality, async_process=async_process)
 
 
 class ImgPromptRequest(Text2ImgRequest):
@@ -313,6 +328,8 @@ class ImgPromptRequest(Text2ImgRequest):
                 w5: float = Form(default=default_lora_weight, ge=-2, le=2),
                 advanced_params: str| None = Form(default=None, description="Advanced parameters in JSON"),
                 require_base64: bool = Form(default=False, description="Return base64 data of generated image"),
+                output_format: OutputFormat | None = Form(default=None, description="Output image format, null for server default"),
+                output_quality: int | None = Form(default=None, ge=1, le=100, description="Output image quality for jpeg, webp and avif, null for server default"),
                 async_process: bool = Form(default=False, description="Set to true will run async and return job info for retrieve generataion result later"),
                 ):
         if isinstance(cn_img1, File):
@@ -362,7 +379,8 @@ class ImgPromptRequest(Text2ImgRequest):
                    performance_selection=performance_selection, aspect_ratios_selection=aspect_ratios_selection,
                    image_number=image_number, image_seed=image_seed, sharpness=sharpness, guidance_scale=guidance_scale,
                    base_model_name=base_model_name, refiner_model_name=refiner_model_name, refiner_switch=refiner_switch,
-                   loras=loras, advanced_params=advanced_params_obj, require_base64=require_base64, async_process=async_process)
+                   loras=loras, advanced_params=advanced_params_obj, require_base64=require_base64,
+                   output_format=output_format, output_quality=output_quality, async_process=async_process)
 
 
 class GeneratedImageResult(BaseModel):
@@ -386,13 +404,27 @@ class AsyncJobResponse(BaseModel):
     job_stage: AsyncJobStage
     job_progess: int
     job_status: str | None
+    job_step_preview: str | None = Field(None, description="Latest step preview image encoded in base64 JPEG, only return when request require step preview")
     job_result: List[GeneratedImageResult] | None
+    job_timings: dict | None = Field(None, description="Span tree of pipeline stages with start time, duration and attributes, only return when request include timings")
 
 
 class JobQueueInfo(BaseModel):
     running_size: int = Field(description="The current running and waiting job count")
     finished_size: int = Field(description="Finished job cound (after auto clean)")
     last_job_id: int = Field(description="Last submit generation job id")
+    model_swap_count: int = Field(description="How many times the started job used different models from previous job")
+
+    model_config = ConfigDict(
+        protected_namespaces=('protect_me_', 'also_protect_')
+    )
+
+
+class CacheStats(BaseModel):
+    size: int = Field(description="Cached item count")
+    bytes: int = Field(description="Cached item total size in bytes")
+    hits: int = Field(description="Cache hit count")
+    misses: int = Field(description="Cache miss count")
 
 
 class AllModelNamesResponse(BaseModel):
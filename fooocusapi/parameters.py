@@ -68,10 +68,14 @@ class GenerationFinishReason(str, Enum):
 
 
 class ImageGenerationResult(object):
-    def __init__(self, im: str | None, seed: int, finish_reason: GenerationFinishReason):
+    def __init__(self, im: str | None, seed: int, finish_reason: GenerationFinishReason,
+                 im_bytes: bytes | None = None, im_media_type: str | None = None):
         self.im = im
         self.seed = seed
         self.finish_reason = finish_reason
+        # Encoded image for in memory output, im is None in this case
+        self.im_bytes = im_bytes
+        self.im_media_type = im_media_type
 
 
 class ImageGenerationParams(object):
@@ -93,7 +97,10 @@ class ImageGenerationParams(object):
                  outpaint_selections: List[str],
                  inpaint_input_image: Dict[str, np.ndarray] | None,
                  image_prompts: List[Tuple[np.ndarray, float, float, str]],
-                 advanced_params: List[any] | None):
+                 advanced_params: List[any] | None,
+                 output_format: str | None = None,
+                 output_quality: int | None = None,
+                 output_in_memory: bool = False):
         self.prompt = prompt
         self.negative_prompt = negative_prompt
         self.style_selections = style_selections
@@ -112,6 +119,9 @@ class ImageGenerationParams(object):
         self.outpaint_selections = outpaint_selections
         self.inpaint_input_image = inpaint_input_image
         self.image_prompts = image_prompts
+        self.output_format = output_format
+        self.output_quality = output_quality
+        self.output_in_memory = output_in_memory
         if advanced_params is None:
             adm_scaler_positive = 1.5
             adm_scaler_negative = 0.8
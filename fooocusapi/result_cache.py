@@ -0,0 +1,68 @@
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from fooocusapi.cache_utils import SqliteCache
+import fooocusapi.file_utils as file_utils
+from fooocusapi.job_store import results_from_json, results_to_json
+from fooocusapi.parameters import GenerationFinishReason, ImageGenerationResult
+
+
+class ResultCache(object):
+    """
+    Content addressed cache of generation results, from digest of deterministic parameters to output files,
+    persisted in a SQLite file and evicted by least recently used and age
+    """
+
+    def __init__(self, path: str, max_size: int, ttl_seconds: float = 0):
+        """
+        :param ttl_seconds: Max age of cached results, 0 for no limit
+        """
+        self.cache = SqliteCache(path, max_size)
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        # Results are put from task listeners, which are called with the task queue locked on GPU thread,
+        # so they are written in background
+        self.write_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="result_cache_")
+
+    def get(self, key: str) -> List[ImageGenerationResult] | None:
+        results = None
+        value = self.cache.get(key)
+        if value is not None:
+            entry = json.loads(value)
+            results = results_from_json(entry['results'])
+            if (self.ttl_seconds > 0 and time.time() - entry['time'] > self.ttl_seconds) or \
+                    not file_utils.output_files_exist(results):
+                # Expired, or output files were deleted
+                self.cache.remove(key)
+                results = None
+
+        if results is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return results
+
+    def put(self, key: str, results: List[ImageGenerationResult]):
+        """
+        Put results in background, returns immediately
+        """
+        if len(results) == 0 or any(r.im is None or r.finish_reason != GenerationFinishReason.success for r in results):
+            return
+        self.write_executor.submit(self.write, key, list(results))
+
+    def write(self, key: str, results: List[ImageGenerationResult]):
+        try:
+            self.cache.put(key, json.dumps({'time': time.time(), 'results': results_to_json(results)}))
+        except Exception as e:
+            print('Result cache write error:', e)
+
+    def stats(self) -> dict:
+        return {
+            'size': len(self.cache),
+            'bytes': 0,
+            'hits': self.hits,
+            'misses': self.misses,
+        }
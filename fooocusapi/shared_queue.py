@@ -0,0 +1,397 @@
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from typing import Dict, Hashable, Set, Tuple
+
+from fooocusapi.job_store import results_from_json, results_to_json
+from fooocusapi.task_queue import QueueTask, TaskPriority, TaskQueue, TaskType, canceled_message
+
+
+class SharedTaskQueue(TaskQueue):
+    """
+    Task queue shared by processes on one host through a SQLite file, API processes add tasks and worker processes claim them.
+    Tasks added, claimed or queried by this process are mirrored in memory, and those ran by other processes
+    are refreshed by polling the file.
+    Only priority and priority aging are applied when claiming tasks, client fairness and affinity scheduling are
+    per process and not applied.
+    """
+
+    columns = "seq, type, req_param, affinity_key, priority, client_key, state, in_queue_millis, start_millis, finish_millis, " \
+              "progress, status, finish_with_error, error_message, task_result"
+
+    def __init__(self, path: str, queue_size: int, hisotry_size: int, worker_id: str | None = None, poll_interval: float = 0.2,
+                 lease_seconds: float = 30):
+        """
+        :param path: The SQLite file path on a local file system, WAL mode does not work on network file systems
+        :param worker_id: Id of this worker process, None if this process does not run tasks
+        :param poll_interval: Seconds between polling tasks ran by other processes and waiting tasks to claim
+        :param lease_seconds: Running tasks are renewed by their worker within this time, or failed by any process
+        """
+        super().__init__(queue_size, hisotry_size)
+        self.worker_id = worker_id
+        self.poll_interval = poll_interval
+        self.lease_millis = int(lease_seconds * 1000)
+        self.lease_check_millis = 0
+        # Tasks claimed by this process, their states are written to the file
+        self.claimed_seqs: Set[int] = set()
+        self.progress_write_millis: Dict[int, int] = {}
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        # Guards the connection, always acquired after self.condition if both needed
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        journal_mode = self.conn.execute("PRAGMA journal_mode=WAL").fetchone()[0]
+        if journal_mode.lower() != 'wal':
+            raise Exception(f"Shared queue file {path} does not support WAL mode, it should be on a local file system")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            type TEXT NOT NULL,
+            req_param BLOB NOT NULL,
+            affinity_key BLOB,
+            priority INTEGER NOT NULL,
+            client_key TEXT,
+            state TEXT NOT NULL,
+            worker_id TEXT,
+            lease_millis INTEGER NOT NULL DEFAULT 0,
+            in_queue_millis INTEGER NOT NULL,
+            start_millis INTEGER NOT NULL DEFAULT 0,
+            finish_millis INTEGER NOT NULL DEFAULT 0,
+            progress INTEGER NOT NULL DEFAULT 0,
+            status TEXT,
+            finish_with_error INTEGER NOT NULL DEFAULT 0,
+            error_message TEXT,
+            task_result TEXT,
+            cancel_requested INTEGER NOT NULL DEFAULT 0
+        )""")
+        self.conn.execute("CREATE INDEX IF NOT EXISTS jobs_state ON jobs (state, priority, seq)")
+
+        if worker_id is not None:
+            # Tasks claimed by this worker before restart were interrupted, queue them again
+            self.conn.execute("UPDATE jobs SET state = 'waiting', worker_id = NULL, start_millis = 0, progress = 0, status = NULL "
+                              "WHERE state = 'running' AND worker_id = ?", (worker_id,))
+
+        self.poll_thread = threading.Thread(target=self.poll_loop, name="shared_queue_poll", daemon=True)
+        self.poll_thread.start()
+
+    def add_task(self, type: TaskType, req_param: dict, affinity_key: Hashable | None = None,
+                 priority: TaskPriority = TaskPriority.normal, client_key: str | None = None,
+                 dedup_key: Hashable | None = None) -> QueueTask | None:
+        in_queue_millis = int(round(time.time() * 1000))
+        req_param_bytes = pickle.dumps(req_param)
+        affinity_key_bytes = pickle.dumps(affinity_key)
+
+        with self.condition:
+            # Only requests added to this process are deduplicated
+            duplicate_task = self.attach_duplicate_task(dedup_key)
+            if duplicate_task is not None:
+                return duplicate_task
+
+            with self.lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    waiting_jobs = self.conn.execute("SELECT priority, client_key FROM jobs WHERE state != 'finished'").fetchall()
+                    if not self.is_under_queue_limits(waiting_jobs, priority, client_key):
+                        self.conn.execute("ROLLBACK")
+                        return None
+                    cursor = self.conn.execute("INSERT INTO jobs (type, req_param, affinity_key, priority, client_key, state, in_queue_millis) "
+                                               "VALUES (?, ?, ?, ?, ?, 'waiting', ?)",
+                                               (type.value, req_param_bytes, affinity_key_bytes, int(priority), client_key, in_queue_millis))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+
+            task = QueueTask(seq=cursor.lastrowid, type=type, req_param=req_param, in_queue_millis=in_queue_millis,
+                             affinity_key=affinity_key, priority=priority, client_key=client_key, dedup_key=dedup_key)
+            self.queue.append(task)
+            self.task_index[task.seq] = task
+            if dedup_key is not None:
+                self.dedup_index[dedup_key] = task
+            self.last_seq = max(self.last_seq, task.seq)
+            self.condition.notify_all()
+            return task
+
+    def is_under_queue_limits(self, waiting_jobs: list, priority: TaskPriority, client_key: str | None) -> bool:
+        if len(waiting_jobs) >= self.queue_size:
+            return False
+
+        priority_queue_size = self.priority_queue_sizes.get(priority)
+        if priority_queue_size is not None and \
+                len([j for j in waiting_jobs if j[0] == priority]) >= priority_queue_size:
+            return False
+
+        if self.client_queue_size > 0 and \
+                len([j for j in waiting_jobs if j[1] == client_key]) >= self.client_queue_size:
+            return False
+        return True
+
+    def get_task(self, seq: int, include_history: bool = False) -> QueueTask | None:
+        with self.condition:
+            if seq in self.task_index:
+                return super().get_task(seq, include_history)
+
+            with self.lock:
+                row = self.conn.execute(f"SELECT {self.columns} FROM jobs WHERE seq = ?", (seq,)).fetchone()
+            if row is None:
+                return None
+
+            task = self.row_to_task(row)
+            if task.is_finished:
+                return task if include_history else None
+
+            # Mirror the task to follow its progress
+            self.queue.append(task)
+            self.queue.sort(key=lambda t: t.seq)
+            self.task_index[task.seq] = task
+            return task
+
+    def row_to_task(self, row: tuple) -> QueueTask:
+        seq, type, req_param, affinity_key, priority, client_key, state, in_queue_millis, start_millis, finish_millis, \
+            progress, status, finish_with_error, error_message, task_result = row
+        task = QueueTask(seq=seq, type=TaskType(type), req_param=pickle.loads(req_param), in_queue_millis=in_queue_millis,
+                         affinity_key=pickle.loads(affinity_key), priority=TaskPriority(priority), client_key=client_key)
+        task.start_millis = start_millis
+        task.finish_progess = progress
+        task.task_status = status
+        if state == 'finished':
+            task.task_result = results_from_json(task_result)
+            task.finish_with_error = bool(finish_with_error)
+            task.error_message = error_message
+            task.finish_millis = finish_millis
+            task.is_finished = True
+        return task
+
+    def wait_for_next_task(self, timeout: float | None = None) -> QueueTask | None:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self.worker_id is not None and self.can_claim_task():
+                task = self.claim_task()
+                if task is not None:
+                    return task
+
+            wait_seconds = self.poll_interval
+            if deadline is not None:
+                wait_seconds = min(wait_seconds, deadline - time.monotonic())
+                if wait_seconds <= 0:
+                    return None
+            with self.condition:
+                # Woken up immediately by tasks added in this process
+                self.condition.wait(wait_seconds)
+
+    def can_claim_task(self) -> bool:
+        """
+        Tasks claimed by this process all finished sampling, and encoding tasks are under limit
+        """
+        with self.condition:
+            claimed_tasks = [self.task_index[seq] for seq in self.claimed_seqs if seq in self.task_index]
+            return all(t.is_encoding for t in claimed_tasks) and len(claimed_tasks) <= self.max_encoding_tasks
+
+    def claim_task(self) -> QueueTask | None:
+        """
+        Claim the next waiting task in the file and start it
+        :returns: The claimed task, or None if there is no waiting task
+        """
+        now_millis = int(round(time.time() * 1000))
+        if self.priority_aging_millis > 0:
+            effective_priority = f"MIN(priority + (? - in_queue_millis) / {int(self.priority_aging_millis)}, " \
+                                 f"(SELECT MAX(priority) FROM jobs WHERE state = 'waiting'))"
+            order_params = (now_millis,)
+        else:
+            effective_priority = "priority"
+            order_params = ()
+
+        with self.condition:
+            with self.lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self.conn.execute(f"SELECT {self.columns} FROM jobs WHERE state = 'waiting' "
+                                            f"ORDER BY {effective_priority} DESC, seq LIMIT 1", order_params).fetchone()
+                    if row is not None:
+                        self.conn.execute("UPDATE jobs SET state = 'running', worker_id = ?, start_millis = ?, lease_millis = ? WHERE seq = ?",
+                                          (self.worker_id, now_millis, now_millis + self.lease_millis, row[0]))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+            if row is None:
+                return None
+
+            task = self.task_index.get(row[0])
+            if task is None:
+                task = self.row_to_task(row)
+                task.start_millis = 0
+                self.queue.append(task)
+                self.queue.sort(key=lambda t: t.seq)
+                self.task_index[task.seq] = task
+                self.last_seq = max(self.last_seq, task.seq)
+            self.claimed_seqs.add(task.seq)
+            self.start_task(task.seq)
+            task.add_listener(self.write_progress)
+            return task
+
+    def write_progress(self, task: QueueTask):
+        if task.is_finished or task.seq not in self.claimed_seqs:
+            return
+
+        # Progress is written at most once per poll interval
+        now_millis = int(round(time.time() * 1000))
+        if now_millis - self.progress_write_millis.get(task.seq, 0) < self.poll_interval * 1000:
+            return
+        self.progress_write_millis[task.seq] = now_millis
+
+        with self.lock:
+            self.conn.execute("UPDATE jobs SET progress = ?, status = ? WHERE seq = ?",
+                              (task.finish_progess, task.task_status, task.seq))
+
+    def finish_task(self, seq: int):
+        with self.condition:
+            task = self.task_index.get(seq)
+            if task is None or task.is_finished:
+                return
+
+            if seq in self.claimed_seqs:
+                self.claimed_seqs.discard(seq)
+                self.progress_write_millis.pop(seq, None)
+                task.remove_listener(self.write_progress)
+                with self.lock:
+                    self.conn.execute("BEGIN IMMEDIATE")
+                    try:
+                        self.conn.execute("UPDATE jobs SET state = 'finished', finish_millis = ?, progress = ?, status = ?, "
+                                          "finish_with_error = ?, error_message = ?, task_result = ? WHERE seq = ?",
+                                          (int(round(time.time() * 1000)), task.finish_progess, task.task_status,
+                                           int(task.finish_with_error), task.error_message,
+                                           results_to_json(task.task_result), seq))
+                        self.conn.execute("DELETE FROM jobs WHERE state = 'finished' AND seq NOT IN "
+                                          "(SELECT seq FROM jobs WHERE state = 'finished' ORDER BY seq DESC LIMIT ?)",
+                                          (self.history_size,))
+                        self.conn.execute("COMMIT")
+                    except Exception:
+                        self.conn.execute("ROLLBACK")
+                        raise
+
+            super().finish_task(seq)
+
+    def poll_loop(self):
+        while True:
+            time.sleep(self.poll_interval)
+            try:
+                now_millis = int(round(time.time() * 1000))
+                if now_millis - self.lease_check_millis >= self.lease_millis / 3:
+                    self.lease_check_millis = now_millis
+                    self.renew_leases(now_millis)
+                    self.expire_leases(now_millis)
+                self.refresh_tasks()
+            except Exception as e:
+                print('Shared queue poll error:', e)
+
+    def renew_leases(self, now_millis: int):
+        with self.condition:
+            seqs = list(self.claimed_seqs)
+        if len(seqs) == 0:
+            return
+
+        with self.lock:
+            self.conn.execute(f"UPDATE jobs SET lease_millis = ? WHERE state = 'running' AND worker_id = ? "
+                              f"AND seq IN ({','.join('?' * len(seqs))})",
+                              (now_millis + self.lease_millis, self.worker_id, *seqs))
+
+    def expire_leases(self, now_millis: int):
+        """
+        Fail running tasks not renewed by their worker, e.g. the worker process crashed or its host was removed
+        """
+        with self.lock:
+            cursor = self.conn.execute("UPDATE jobs SET state = 'finished', finish_millis = ?, finish_with_error = 1, error_message = ? "
+                                       "WHERE state = 'running' AND lease_millis < ?",
+                                       (now_millis, 'Worker stopped before job finished', now_millis))
+        if cursor.rowcount > 0:
+            print(f"[Task Queue] Fail {cursor.rowcount} jobs of stopped workers")
+
+    def refresh_tasks(self):
+        """
+        Refresh mirrored tasks ran by other processes from the file, and cancel requests of tasks claimed by this process
+        """
+        with self.condition:
+            seqs = [t.seq for t in self.queue]
+        if len(seqs) == 0:
+            return
+
+        with self.lock:
+            rows = self.conn.execute(f"SELECT seq, state, start_millis, finish_millis, progress, status, finish_with_error, "
+                                     f"error_message, task_result, cancel_requested FROM jobs WHERE seq IN ({','.join('?' * len(seqs))})",
+                                     seqs).fetchall()
+        rows = {row[0]: row for row in rows}
+
+        with self.condition:
+            for seq in seqs:
+                task = self.task_index.get(seq)
+                if task is None or task.is_finished:
+                    continue
+
+                row = rows.get(seq)
+                if seq in self.claimed_seqs:
+                    if row is not None and row[9]:
+                        task.cancel_requested = True
+                    continue
+
+                if row is None:
+                    task.set_result([], True, 'Job removed from shared queue')
+                    TaskQueue.finish_task(self, seq)
+                    continue
+
+                _, state, start_millis, finish_millis, progress, status, finish_with_error, error_message, task_result, _ = row
+                if state == 'waiting':
+                    continue
+                if task.start_millis == 0:
+                    task.start_millis = start_millis
+                if state == 'finished':
+                    task.set_result(results_from_json(task_result) or [], bool(finish_with_error), error_message)
+                    TaskQueue.finish_task(self, seq)
+                    task.finish_millis = finish_millis
+                elif progress != task.finish_progess or status != task.task_status:
+                    task.set_progress(progress, status)
+
+    def cancel_task(self, seq: int, canceled_result: any, detach: bool = False) -> QueueTask | None:
+        with self.condition:
+            task = self.get_task(seq)
+            if task is None:
+                return None
+
+            if detach:
+                task.request_count -= 1
+                if task.request_count > 0:
+                    return task
+
+            task.cancel_requested = True
+            self.remove_dedup_key(task)
+            if seq in self.claimed_seqs:
+                return task
+
+            # Finish the task if still waiting, or request the worker claimed it to stop it
+            with self.lock:
+                self.conn.execute("BEGIN IMMEDIATE")
+                try:
+                    row = self.conn.execute("SELECT state FROM jobs WHERE seq = ?", (seq,)).fetchone()
+                    state = None if row is None else row[0]
+                    if state == 'waiting':
+                        self.conn.execute("UPDATE jobs SET state = 'finished', finish_millis = ?, status = 'Canceled', "
+                                          "finish_with_error = 1, error_message = ?, task_result = ? WHERE seq = ?",
+                                          (int(round(time.time() * 1000)), canceled_message, results_to_json(canceled_result), seq))
+                    elif state == 'running':
+                        self.conn.execute("UPDATE jobs SET cancel_requested = 1 WHERE seq = ?", (seq,))
+                    self.conn.execute("COMMIT")
+                except Exception:
+                    self.conn.execute("ROLLBACK")
+                    raise
+
+            if state == 'waiting':
+                task.set_result(canceled_result, True, canceled_message)
+                TaskQueue.finish_task(self, seq)
+            return task
+
+    def get_queue_info(self) -> Tuple[int, int, int]:
+        with self.lock:
+            row = self.conn.execute("SELECT SUM(state != 'finished'), SUM(state = 'finished'), MAX(seq) FROM jobs").fetchone()
+        return row[0] or 0, row[1] or 0, row[2] or 0
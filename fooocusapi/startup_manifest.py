@@ -0,0 +1,122 @@
+import hashlib
+import json
+import os
+import site
+import sys
+import time
+from contextlib import contextmanager
+from typing import Dict, List, Tuple
+
+
+class StartupTimer(object):
+    """
+    Records time of each startup stage, printed as a breakdown when the app is ready to start
+    """
+
+    def __init__(self):
+        self.start_time = time.perf_counter()
+        self.stages: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        stage_start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages.append((name, time.perf_counter() - stage_start_time))
+
+    def print_breakdown(self):
+        total = time.perf_counter() - self.start_time
+        breakdown = ', '.join(f"{name} {seconds:.2f}s" for name, seconds in self.stages)
+        print(f"[Startup] Prepared in {total:.2f}s: {breakdown}")
+
+
+class StartupManifest(object):
+    """
+    Signatures of requirements, repository and model files verified at last start, saved in a JSON file.
+    A startup step is skipped when its signature is unchanged, so nothing is probed over network.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, any] = {}
+        if os.path.isfile(path):
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self.entries = json.load(f)
+            except Exception as e:
+                print(f"[Startup] Ignore broken startup manifest {path}: {e}")
+
+    def matches(self, name: str, signature: any) -> bool:
+        return signature is not None and self.entries.get(name) == signature
+
+    def update(self, name: str, signature: any):
+        if signature is None:
+            self.entries.pop(name, None)
+        else:
+            self.entries[name] = signature
+
+    def save(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.entries, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+def file_stat(path: str) -> List[int] | None:
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def requirements_signature(requirements_file: str) -> dict | None:
+    """
+    Content hash of requirements file, with Python executable and modified time of site-packages dirs,
+    which change when packages are installed, upgraded or removed
+    """
+    try:
+        with open(requirements_file, 'rb') as f:
+            requirements_hash = hashlib.sha256(f.read()).hexdigest()
+    except OSError:
+        return None
+
+    site_dirs = site.getsitepackages() + [site.getusersitepackages()]
+    return {
+        'python': sys.executable,
+        'requirements_sha256': requirements_hash,
+        'site_packages': {d: file_stat(d) for d in site_dirs if os.path.isdir(d)},
+    }
+
+
+def repository_signature(repo_dir: str, commit_hash: str) -> dict | None:
+    """
+    Signature of a git repository checked out at commit, read from .git directly without opening the repository.
+    None if it is not checked out at the commit.
+    """
+    git_dir = os.path.join(repo_dir, '.git')
+    try:
+        with open(os.path.join(git_dir, 'HEAD'), 'r', encoding='utf-8') as f:
+            head = f.read().strip()
+    except OSError:
+        return None
+
+    # Checked out commit is a detached head
+    if head != commit_hash:
+        return None
+    return {'commit': commit_hash, 'index': file_stat(os.path.join(git_dir, 'index'))}
+
+
+def files_signature(paths: List[str]) -> Dict[str, List[int]] | None:
+    """
+    Size and modified time of files, None if any file is missing
+    """
+    signature = {}
+    for path in paths:
+        stat = file_stat(path)
+        if stat is None:
+            return None
+        signature[path] = stat
+    return signature
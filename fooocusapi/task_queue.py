@@ -1,6 +1,8 @@
+from collections import deque
 from enum import Enum
+import threading
 import time
-from typing import List, Tuple
+from typing import Callable, Deque, Dict, Hashable, List, Tuple
 
 
 class TaskType(str, Enum):
@@ -10,6 +12,16 @@ class TaskType(str, Enum):
     img_prompt = 'Image Prompt'
 
 
+class TaskPriority(int, Enum):
+    low = 0
+    normal = 1
+    high = 2
+
+
+# Error message of canceled tasks, they are finished with error and 'Canceled' status
+canceled_message = 'Job canceled'
+
+
 class QueueTask(object):
     is_finished: bool = False
     finish_progess: int = 0
@@ -19,101 +31,416 @@ class QueueTask(object):
     task_status: str | None = None
     task_result: any = None
     error_message: str | None = None
+    # Set when the task is canceled while running, the worker stops it at next sampling step or image
+    cancel_requested: bool = False
+    # Set when the task finished sampling and only waits for its output images encoded, next task can be started
+    is_encoding: bool = False
+    # Only the latest step preview image is kept, encoded to JPEG lazily when requested
+    step_preview: any = None
+    step_preview_jpeg: bytes | None = None
+    # JobTrace of pipeline stages, recorded by the worker
+    trace: any = None
 
-    def __init__(self, seq: int, type: TaskType, req_param: dict, in_queue_millis: int):
+    def __init__(self, seq: int, type: TaskType, req_param: dict, in_queue_millis: int, affinity_key: Hashable | None = None,
+                 priority: TaskPriority = TaskPriority.normal, client_key: str | None = None, dedup_key: Hashable | None = None):
         self.seq = seq
         self.type = type
         self.req_param = req_param
         self.in_queue_millis = in_queue_millis
+        self.priority = priority
+        # Tasks are fairly scheduled between clients of same priority
+        self.client_key = client_key
+        # Tasks with same affinity key use same models, see TaskQueue.affinity_scheduling
+        self.affinity_key = affinity_key
+        # Requests with same dedup key are attached to this task, see TaskQueue.add_task
+        self.dedup_key = dedup_key
+        # How many requests are attached to this task
+        self.request_count = 1
+        # How many times later tasks were started before this task
+        self.skipped_count = 0
+        self.listeners: List[Callable[['QueueTask'], None]] = []
+
+    def add_listener(self, listener: Callable[['QueueTask'], None]):
+        """
+        Add a listener called with the task whenever its progress, result or finish state changed
+        """
+        self.listeners = self.listeners + [listener]
+
+    def remove_listener(self, listener: Callable[['QueueTask'], None]):
+        self.listeners = [l for l in self.listeners if l is not listener]
+
+    def notify_listeners(self):
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                print('Task listener error:', e)
 
-    def set_progress(self, progress: int, status: str | None):
+    def set_progress(self, progress: int, status: str | None, preview: any = None):
         if progress > 100:
             progress = 100
         self.finish_progess = progress
         self.task_status = status
+        if preview is not None:
+            self.step_preview = preview
+            self.step_preview_jpeg = None
+        self.notify_listeners()
+
+    def get_step_preview_jpeg(self) -> bytes | None:
+        """
+        Get the latest step preview image encoded in JPEG, encode it if not encoded yet
+        """
+        preview = self.step_preview
+        if preview is None:
+            return None
+
+        preview_jpeg = self.step_preview_jpeg
+        if preview_jpeg is None:
+            from fooocusapi.file_utils import narray_to_jpeg_bytes
+            preview_jpeg = narray_to_jpeg_bytes(preview)
+            if preview is self.step_preview:
+                self.step_preview_jpeg = preview_jpeg
+        return preview_jpeg
+
+    def release_step_preview(self):
+        self.step_preview = None
+        self.step_preview_jpeg = None
 
     def set_result(self, task_result: any, finish_with_error: bool, error_message: str | None = None):
         if not finish_with_error:
             self.finish_progess = 100
             self.task_status = 'Finished'
+        elif error_message == canceled_message:
+            self.task_status = 'Canceled'
         self.task_result = task_result
         self.finish_with_error = finish_with_error
         self.error_message = error_message
+        self.notify_listeners()
 
 
 class TaskQueue(object):
-    queue: List[QueueTask] = []
-    history: List[QueueTask] = []
-    last_seq = 0
-
     def __init__(self, queue_size: int, hisotry_size: int):
         self.queue_size = queue_size
         self.history_size = hisotry_size
+        self.queue: List[QueueTask] = []
+        self.history: Deque[QueueTask] = deque()
+        # Index of all tasks in queue and history by seq
+        self.task_index: Dict[int, QueueTask] = {}
+        self.last_seq = 0
+        # How many started tasks encoding output images are allowed when starting next task
+        self.max_encoding_tasks = 2
+        # Affinity key of the last started task, and how many times it changed
+        self.last_affinity_key: Hashable | None = None
+        self.model_swap_count = 0
+        # Guards all the states above, and notified whenever a task is added or finished,
+        # so waiting workers wake up immediately
+        self.condition = threading.Condition(threading.RLock())
+
+        # Start waiting tasks with same affinity key as the last started task first to avoid reloading models,
+        # the earliest waiting task is started anyway after skipped affinity_max_skips times or waited affinity_max_wait_millis
+        self.affinity_scheduling = False
+        self.affinity_max_skips = 3
+        self.affinity_max_wait_millis = 60000
+
+        # Queue size limit of each priority, in addition to queue_size
+        self.priority_queue_sizes: Dict[TaskPriority, int] = {}
+        # Queue size limit of each client, 0 for no limit
+        self.client_queue_size = 0
+        # Waiting tasks are raised one priority every priority_aging_millis, 0 for never
+        self.priority_aging_millis = 60000
+        # Weight of clients in fair scheduling, default 1
+        self.client_weights: Dict[str, float] = {}
+        # Start time fair queuing virtual times, of the system and of each client
+        self.virtual_time = 0.
+        self.client_virtual_times: Dict[str | None, float] = {}
 
-    def add_task(self, type: TaskType, req_param: dict) -> QueueTask | None:
+        # Records tasks to survive restarts, see fooocusapi.job_store
+        self.job_store = None
+
+        # Unfinished and successfully finished tasks in history by dedup key
+        self.dedup_index: Dict[Hashable, QueueTask] = {}
+
+    def add_task(self, type: TaskType, req_param: dict, affinity_key: Hashable | None = None,
+                 priority: TaskPriority = TaskPriority.normal, client_key: str | None = None,
+                 dedup_key: Hashable | None = None) -> QueueTask | None:
         """
-        Create and add task to queue
-        :returns: The created task's seq, or None if reach the queue size limit
+        Create and add task to queue, or attach to the task with same dedup key if it is unfinished or finished successfully
+        :returns: The created or attached task, or None if reach the queue size limit of queue, priority or client
         """
-        if len(self.queue) >= self.queue_size:
+        with self.condition:
+            duplicate_task = self.attach_duplicate_task(dedup_key)
+            if duplicate_task is not None:
+                return duplicate_task
+
+            if len(self.queue) >= self.queue_size:
+                return None
+
+            priority_queue_size = self.priority_queue_sizes.get(priority)
+            if priority_queue_size is not None and \
+                    len([t for t in self.queue if t.priority == priority]) >= priority_queue_size:
+                return None
+
+            if self.client_queue_size > 0 and \
+                    len([t for t in self.queue if t.client_key == client_key]) >= self.client_queue_size:
+                return None
+
+            task = QueueTask(seq=self.last_seq+1, type=type, req_param=req_param,
+                             in_queue_millis=int(round(time.time() * 1000)), affinity_key=affinity_key,
+                             priority=priority, client_key=client_key, dedup_key=dedup_key)
+            self.queue.append(task)
+            self.task_index[task.seq] = task
+            if dedup_key is not None:
+                self.dedup_index[dedup_key] = task
+            self.last_seq = task.seq
+            if self.job_store is not None:
+                self.job_store.add_job(task)
+            self.condition.notify_all()
+            return task
+
+    def attach_duplicate_task(self, dedup_key: Hashable | None) -> QueueTask | None:
+        if dedup_key is None:
             return None
 
-        task = QueueTask(seq=self.last_seq+1, type=type, req_param=req_param,
-                         in_queue_millis=int(round(time.time() * 1000)))
-        self.queue.append(task)
-        self.last_seq = task.seq
-        return task
+        with self.condition:
+            task = self.dedup_index.get(dedup_key)
+            if task is None or task.cancel_requested or task.finish_with_error:
+                return None
+            if task.is_finished and task.task_result is not None:
+                from fooocusapi.file_utils import output_files_exist
+                if not output_files_exist(task.task_result):
+                    # Output files were deleted, generate again
+                    self.remove_dedup_key(task)
+                    return None
+            task.request_count += 1
+            print(f"[Task Queue] Attach duplicate request to task, seq={task.seq}")
+            return task
+
+    def remove_dedup_key(self, task: QueueTask):
+        if task.dedup_key is not None and self.dedup_index.get(task.dedup_key) is task:
+            del self.dedup_index[task.dedup_key]
+
+    def restore_tasks(self, waiting_tasks: List[QueueTask], finished_tasks: List[QueueTask]):
+        """
+        Restore tasks saved before restart with their original seq, regardless of queue size limits
+        """
+        with self.condition:
+            for task in finished_tasks[-self.history_size:] if self.history_size > 0 else []:
+                self.history.append(task)
+                self.task_index[task.seq] = task
+            for task in waiting_tasks:
+                task.start_millis = 0
+                self.queue.append(task)
+                self.task_index[task.seq] = task
+            self.queue.sort(key=lambda t: t.seq)
+            self.last_seq = max([self.last_seq] + [t.seq for t in waiting_tasks] + [t.seq for t in finished_tasks])
+            self.condition.notify_all()
 
     def get_task(self, seq: int, include_history: bool = False) -> QueueTask | None:
-        for task in self.queue:
-            if task.seq == seq:
-                return task
+        with self.condition:
+            task = self.task_index.get(seq)
+            if task is None:
+                return None
+
+            if task.is_finished and not include_history:
+                return None
 
-        if include_history:
-            for task in self.history:
-                if task.seq == seq:
+            return task
+
+    def get_queue_info(self) -> Tuple[int, int, int]:
+        """
+        :returns: Count of unfinished tasks, count of finished tasks in history and the last seq
+        """
+        with self.condition:
+            return len(self.queue), len(self.history), self.last_seq
+
+    def select_next_task(self) -> QueueTask | None:
+        """
+        Select the next task to start according to scheduling policy
+        :returns: The next task, or None if there is a running task or no waiting task
+        """
+        with self.condition:
+            waiting_tasks = []
+            encoding_count = 0
+            for task in self.queue:
+                if task.is_encoding:
+                    encoding_count += 1
+                elif task.start_millis != 0:
+                    return None
+                else:
+                    waiting_tasks.append(task)
+
+            if len(waiting_tasks) == 0 or encoding_count > self.max_encoding_tasks:
+                return None
+
+            # Only tasks of the highest priority are candidates, aged tasks are raised up to it
+            now_millis = int(round(time.time() * 1000))
+            top_priority = max(task.priority for task in waiting_tasks)
+            candidate_tasks = [task for task in waiting_tasks
+                               if self.get_effective_priority(task, now_millis) >= top_priority]
+
+            # Fair between clients, the earliest task of the client with least virtual time goes first
+            earliest_task = min(candidate_tasks, key=lambda task: (self.get_client_virtual_time(task.client_key), task.seq))
+
+            if not self.affinity_scheduling or self.last_affinity_key is None \
+                    or earliest_task.affinity_key == self.last_affinity_key:
+                return earliest_task
+
+            if earliest_task.skipped_count >= self.affinity_max_skips or \
+                    now_millis - earliest_task.in_queue_millis >= self.affinity_max_wait_millis:
+                return earliest_task
+
+            for task in candidate_tasks:
+                if task.affinity_key == self.last_affinity_key:
                     return task
+            return earliest_task
+
+    def get_effective_priority(self, task: QueueTask, now_millis: int) -> int:
+        if self.priority_aging_millis <= 0:
+            return task.priority
+        return task.priority + (now_millis - task.in_queue_millis) // self.priority_aging_millis
 
-        return None
+    def get_client_virtual_time(self, client_key: str | None) -> float:
+        return max(self.client_virtual_times.get(client_key, 0.), self.virtual_time)
 
     def is_task_ready_to_start(self, seq: int) -> bool:
-        task = self.get_task(seq)
-        if task is None:
-            return False
+        with self.condition:
+            task = self.get_task(seq)
+            if task is None:
+                return False
+
+            next_task = self.select_next_task()
+            return next_task is not None and next_task.seq == seq
+
+    def wait_for_task_ready(self, seq: int, timeout: float | None = None) -> bool:
+        """
+        Block until the task is selected as next task to start
+        :returns: True if the task is ready to start, False on timeout or if the task is not in queue
+        """
+        with self.condition:
+            return self.condition.wait_for(lambda: self.get_task(seq) is None or self.is_task_ready_to_start(seq),
+                                           timeout) and self.get_task(seq) is not None
 
-        return self.queue[0].seq == seq
+    def wait_for_next_task(self, timeout: float | None = None) -> QueueTask | None:
+        """
+        Block until next task can be started, and start it
+        :returns: The started task, or None on timeout
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.select_next_task() is not None, timeout):
+                return None
+            task = self.select_next_task()
+            self.start_task(task.seq)
+            return task
 
     def start_task(self, seq: int):
-        task = self.get_task(seq)
-        if task is not None:
-            task.start_millis = int(round(time.time() * 1000))
+        with self.condition:
+            task = self.get_task(seq)
+            if task is not None and task.start_millis == 0:
+                task.start_millis = int(round(time.time() * 1000))
+
+                for waiting_task in self.queue:
+                    if waiting_task is task:
+                        break
+                    if waiting_task.start_millis == 0:
+                        waiting_task.skipped_count += 1
+
+                # Advance virtual times for fair scheduling between clients
+                self.virtual_time = self.get_client_virtual_time(task.client_key)
+                self.client_virtual_times[task.client_key] = self.virtual_time + 1. / self.client_weights.get(task.client_key, 1.)
+                self.clean_client_virtual_times()
+
+                if self.last_affinity_key is not None and task.affinity_key != self.last_affinity_key:
+                    self.model_swap_count += 1
+                self.last_affinity_key = task.affinity_key
+
+                if self.job_store is not None:
+                    self.job_store.start_job(task)
+
+    def release_task(self, seq: int):
+        """
+        Mark the task finished sampling, next task can be started while its output images are encoding
+        """
+        with self.condition:
+            task = self.get_task(seq)
+            if task is not None and task.start_millis != 0:
+                task.is_encoding = True
+                self.condition.notify_all()
+
+    def cancel_task(self, seq: int, canceled_result: any, detach: bool = False) -> QueueTask | None:
+        """
+        Cancel the task, finish it with canceled_result if not started yet, or request the worker to stop it
+        :param detach: Only detach a request from the task, and cancel it if no other request attached
+        :returns: The canceled task, or None if the task is not in queue
+        """
+        with self.condition:
+            task = self.get_task(seq)
+            if task is None:
+                return None
+
+            if detach:
+                task.request_count -= 1
+                if task.request_count > 0:
+                    return task
+
+            task.cancel_requested = True
+            self.remove_dedup_key(task)
+            if task.start_millis == 0:
+                task.set_result(canceled_result, True, canceled_message)
+                self.finish_task(seq)
+            return task
+
+    def clean_client_virtual_times(self):
+        # Clients fallen behind system virtual time are same as new clients
+        if len(self.client_virtual_times) > len(self.queue) * 2 + 16:
+            self.client_virtual_times = {k: v for k, v in self.client_virtual_times.items() if v > self.virtual_time}
 
     def finish_task(self, seq: int):
-        task = self.get_task(seq)
-        if task is not None:
-            task.is_finished = True
-            task.finish_millis = int(round(time.time() * 1000))
+        with self.condition:
+            task = self.get_task(seq)
+            if task is not None:
+                task.is_finished = True
+                task.finish_millis = int(round(time.time() * 1000))
 
-            # Move task to history
-            self.queue.remove(task)
-            self.history.append(task)
+                # Move task to history
+                self.queue.remove(task)
+                self.history.append(task)
+                if task.finish_with_error:
+                    self.remove_dedup_key(task)
 
-            # Clean history
-            if len(self.history) > self.history_size:
-                removed_task = self.history.pop(0)
-                print(f"Clean task history, remove task: {removed_task.seq}")
+                # Clean history
+                while len(self.history) > self.history_size:
+                    removed_task = self.history.popleft()
+                    del self.task_index[removed_task.seq]
+                    self.remove_dedup_key(removed_task)
+                    print(f"Clean task history, remove task: {removed_task.seq}")
 
+                if self.job_store is not None:
+                    self.job_store.finish_job(task)
+
+                # Wake up the next task
+                self.condition.notify_all()
+                task.notify_listeners()
 
-class TaskOutputs:
-    outputs = []
 
+class TaskOutputs:
     def __init__(self, task: QueueTask):
         self.task = task
+        self.outputs = []
 
     def append(self, args: List[any]):
-        self.outputs.append(args)
         if len(args) >= 2:
             if args[0] == 'preview' and isinstance(args[1], Tuple) and len(args[1]) >= 2:
+                # Previews are not buffered, the task only keeps the latest one
                 number = args[1][0]
                 text = args[1][1]
-                self.task.set_progress(number, text)
\ No newline at end of file
+                preview = args[1][2] if len(args[1]) >= 3 else None
+                self.task.set_progress(number, text, preview)
+                return
+        self.outputs.append(args)
+
+    def release(self):
+        """
+        Drop all buffered outputs and the step preview, called when the task finished
+        """
+        self.outputs = []
+        self.task.release_step_preview()
\ No newline at end of file
@@ -0,0 +1,177 @@
+import json
+import os
+import random
+import threading
+import time
+from typing import Dict, List
+
+
+class Span(object):
+    """
+    Timed operation in a job trace, with attributes and child spans
+    """
+
+    def __init__(self, name: str, start_ns: int | None = None, parent: 'Span | None' = None, attributes: Dict[str, any] | None = None):
+        self.span_id = '%016x' % random.getrandbits(64)
+        self.name = name
+        self.start_ns = time.time_ns() if start_ns is None else start_ns
+        self.end_ns = 0
+        self.parent = parent
+        self.attributes = {} if attributes is None else attributes
+        self.children: List[Span] = []
+
+    def set_attribute(self, key: str, value: any):
+        self.attributes[key] = value
+
+    def end(self, end_ns: int | None = None):
+        if self.end_ns == 0:
+            self.end_ns = time.time_ns() if end_ns is None else end_ns
+
+    def to_dict(self) -> dict:
+        end_ns = time.time_ns() if self.end_ns == 0 else self.end_ns
+        return {
+            'name': self.name,
+            'start_millis': self.start_ns // 1000000,
+            'duration_ms': round((end_ns - self.start_ns) / 1e6, 3),
+            'attributes': self.attributes,
+            'children': [child.to_dict() for child in self.children],
+        }
+
+
+class JobTrace(object):
+    """
+    Span tree of a job. The root span covers the job from queued to finished, pipeline stages are its children,
+    and a stage is ended when the next stage started, so stages of a long function are recorded without nesting code.
+    """
+
+    def __init__(self, name: str, start_millis: int, attributes: Dict[str, any] | None = None):
+        self.trace_id = '%032x' % random.getrandbits(128)
+        self.root = Span(name, start_ns=start_millis * 1000000, attributes=attributes)
+        self.stage: Span | None = None
+        # Spans may be added by output encoding threads
+        self.lock = threading.Lock()
+
+    def add_span(self, name: str, start_ns: int | None = None, end_ns: int | None = None, parent: Span | None = None, **attributes) -> Span:
+        """
+        Add a span under parent, or under current stage if parent is None, the span is ended if end_ns is given
+        """
+        with self.lock:
+            if parent is None:
+                parent = self.root if self.stage is None else self.stage
+            span = Span(name, start_ns=start_ns, parent=parent, attributes=attributes)
+            if end_ns is not None:
+                span.end(end_ns)
+            parent.children.append(span)
+        return span
+
+    def start_stage(self, name: str, **attributes) -> Span:
+        """
+        End current stage and start a new stage under root span
+        """
+        self.end_stage()
+        stage = self.add_span(name, parent=self.root, **attributes)
+        self.stage = stage
+        return stage
+
+    def end_stage(self):
+        with self.lock:
+            if self.stage is not None:
+                end_span_tree(self.stage, time.time_ns())
+                self.stage = None
+
+    def end(self):
+        self.end_stage()
+        with self.lock:
+            end_span_tree(self.root, time.time_ns())
+
+    def to_dict(self) -> dict:
+        with self.lock:
+            return {'trace_id': self.trace_id, **self.root.to_dict()}
+
+    def to_otel(self, service_name: str = 'fooocus-api') -> dict:
+        """
+        Convert to OpenTelemetry OTLP JSON ExportTraceServiceRequest
+        """
+        with self.lock:
+            spans = [otel_span(self.trace_id, span) for span in walk_span_tree(self.root)]
+        return {'resourceSpans': [{
+            'resource': {'attributes': otel_attributes({'service.name': service_name})},
+            'scopeSpans': [{'scope': {'name': 'fooocusapi'}, 'spans': spans}],
+        }]}
+
+
+def end_span_tree(span: Span, end_ns: int):
+    """
+    End span and its unfinished children, e.g. spans interrupted by exceptions
+    """
+    for child in span.children:
+        end_span_tree(child, end_ns)
+    span.end(end_ns)
+
+
+def walk_span_tree(span: Span) -> List[Span]:
+    spans = [span]
+    for child in span.children:
+        spans += walk_span_tree(child)
+    return spans
+
+
+def otel_value(value: any) -> dict:
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        # int64 is string in OTLP JSON
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    if isinstance(value, (list, tuple)):
+        return {'arrayValue': {'values': [otel_value(v) for v in value]}}
+    return {'stringValue': str(value)}
+
+
+def otel_attributes(attributes: Dict[str, any]) -> List[dict]:
+    return [{'key': key, 'value': otel_value(value)} for key, value in attributes.items()]
+
+
+def otel_span(trace_id: str, span: Span) -> dict:
+    return {
+        'traceId': trace_id,
+        'spanId': span.span_id,
+        'parentSpanId': '' if span.parent is None else span.parent.span_id,
+        'name': span.name,
+        # SPAN_KIND_INTERNAL
+        'kind': 1,
+        'startTimeUnixNano': str(span.start_ns),
+        'endTimeUnixNano': str(span.end_ns if span.end_ns != 0 else time.time_ns()),
+        'attributes': otel_attributes(span.attributes),
+    }
+
+
+class TraceFileExporter(object):
+    """
+    Append finished job traces to a file as OTLP JSON lines, which can be read by OpenTelemetry collector otlpjsonfile receiver
+    """
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.lock = threading.Lock()
+
+    def export(self, trace: JobTrace):
+        line = json.dumps(trace.to_otel(), separators=(',', ':'))
+        with self.lock:
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(line + '\n')
+
+
+# Set by --trace-file
+trace_exporter: TraceFileExporter | None = None
+
+
+def export_trace(trace: JobTrace):
+    if trace_exporter is None:
+        return
+    try:
+        trace_exporter.export(trace)
+    except Exception as e:
+        print('Export trace error:', e)
@@ -1,31 +1,148 @@
 import copy
+import json
 import random
 import time
 import numpy as np
 import torch
-from typing import List
-from fooocusapi.file_utils import save_output_file
+import threading
+from concurrent.futures import Future
+from typing import Callable, List
+from fooocusapi.cache_utils import LRUCache, SqliteCache
+import fooocusapi.file_utils as file_utils
+import fooocusapi.metrics as metrics
+import fooocusapi.tracing as tracing
 from fooocusapi.parameters import inpaint_model_version, GenerationFinishReason, ImageGenerationParams, ImageGenerationResult
-from fooocusapi.task_queue import QueueTask, TaskQueue, TaskOutputs
+from fooocusapi.task_queue import QueueTask, TaskQueue, TaskOutputs, canceled_message
 
 save_log = True
 task_queue = TaskQueue(queue_size=3, hisotry_size=6)
+# False for API only process, tasks are ran by worker processes of shared task queue
+task_schedule_enabled = True
+# Seconds to wait before retrying when taking next task failed
+task_schedule_retry_seconds = 1
+
+
+def cond_nbytes(cond) -> int:
+    nbytes = 0
+    for c, extra in cond:
+        nbytes += c.nelement() * c.element_size()
+        pooled = extra.get('pooled_output')
+        if isinstance(pooled, torch.Tensor):
+            nbytes += pooled.nelement() * pooled.element_size()
+    return nbytes
+
+
+# Encoded prompt conditions across requests, keyed by models, loras, texts and pool_top_k
+cond_cache = LRUCache(max_size=256, max_bytes=512 * 1024 * 1024, sizeof=cond_nbytes)
+# The clip model which cached conditions are encoded by
+cond_cache_clip = None
+
+
+# Fooocus V2 prompt expansions, which are deterministic in prompt and seed
+expansion_cache = LRUCache(max_size=1024)
+# Optional persistent expansion cache, written through from expansion_cache
+expansion_disk_cache: SqliteCache | None = None
+
+
+def final_expansion_cached(final_expansion, prompt: str, seed: int) -> str:
+    key = (prompt, seed)
+    expansion = expansion_cache.get(key)
+    if expansion is not None:
+        return expansion
+
+    disk_key = json.dumps(key, ensure_ascii=False)
+    if expansion_disk_cache is not None:
+        expansion = expansion_disk_cache.get(disk_key)
+
+    if expansion is None:
+        expansion = final_expansion(prompt, seed)
+        if expansion_disk_cache is not None:
+            expansion_disk_cache.put(disk_key, expansion)
+
+    expansion_cache.put(key, expansion)
+    return expansion
+
+
+def refresh_cond_cache(clip):
+    global cond_cache_clip
+    if clip is not cond_cache_clip:
+        # Models reloaded, cached conditions are stale
+        cond_cache.clear()
+        cond_cache_clip = clip
 
 
 def process_top():
     import fcbh.model_management
     fcbh.model_management.interrupt_current_processing()
 
+
+def task_schedule_loop():
+    """
+    The GPU consumer loop, takes tasks from head of queue and process them one by one
+    """
+    while True:
+        try:
+            queue_task = task_queue.wait_for_next_task()
+        except Exception as e:
+            # e.g. shared queue file locked by other processes, retry later
+            print('Wait for next task error:', e)
+            time.sleep(task_schedule_retry_seconds)
+            continue
+
+        try:
+            params = ImageGenerationParams(**queue_task.req_param['params'])
+            process_generate(queue_task, params, wait_outputs=False)
+        except Exception as e:
+            print('Task schedule error:', e)
+            try:
+                if not queue_task.is_finished:
+                    queue_task.set_result([], True, str(e))
+                    task_queue.finish_task(queue_task.seq)
+            except Exception as e:
+                print('Finish task error:', e)
+
+
+def call_when_all_done(futures: List[Future], callback: Callable[[], None]):
+    """
+    Call callback once all futures are done, in the thread which completed the last one
+    """
+    remaining = len(futures)
+    lock = threading.Lock()
+
+    def on_done(_):
+        nonlocal remaining
+        with lock:
+            remaining -= 1
+            if remaining > 0:
+                return
+        callback()
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+
+def start_task_schedule_thread() -> threading.Thread | None:
+    if not task_schedule_enabled:
+        return None
+    thread = threading.Thread(target=task_schedule_loop, name="task_schedule", daemon=True)
+    thread.start()
+    return thread
+
+
 @torch.no_grad()
 @torch.inference_mode()
-def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> List[ImageGenerationResult]:
+def process_generate(queue_task: QueueTask, params: ImageGenerationParams, wait_outputs: bool = True) -> List[ImageGenerationResult]:
+    """
+    :param wait_outputs: False to return once sampling finished, the task is finished after its output images encoded
+        in background, and next task can be started meanwhile
+    """
     try:
         import modules.default_pipeline as pipeline
     except Exception as e:
         print('Import default pipeline error:', e)
         if not queue_task.is_finished:
-            task_queue.finish_task(queue_task.seq)
             queue_task.set_result([], True, str(e))
+            task_queue.finish_task(queue_task.seq)
             print(f"[Task Queue] Finish task with error, seq={queue_task.seq}")
         return []
 
@@ -36,6 +153,7 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
     import modules.config as path
     import modules.advanced_parameters as advanced_parameters
     import modules.constants as constants
+    import fcbh.model_management
     import fooocus_extras.preprocessors as preprocessors
     import fooocus_extras.ip_adapter as ip_adapter
     from modules.util import remove_empty_str, resize_image, HWC3, set_image_shape_ceil, get_image_shape_ceil, get_shape_ceil, resample_image
@@ -45,6 +163,8 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
     from modules.sdxl_styles import apply_style, fooocus_expansion, apply_wildcards
 
     outputs = TaskOutputs(queue_task)
+    trace = tracing.JobTrace(queue_task.type.name, queue_task.in_queue_millis, {'job_id': queue_task.seq})
+    queue_task.trace = trace
 
     def refresh_seed(r, seed_string):
         if r:
@@ -63,6 +183,33 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
         outputs.append(['preview', (number, text, None)])
         queue_task.set_progress(number, text)
 
+    def save_output_async(img: np.ndarray) -> Future:
+        save_output = file_utils.encode_output_bytes if params.output_in_memory else file_utils.save_output_file
+        parent_span = trace.stage
+
+        def save_output_timed():
+            save_start_time = time.perf_counter()
+            save_start_ns = time.time_ns()
+            output = save_output(img, params.output_format, params.output_quality)
+            metrics.output_encode_seconds.observe(time.perf_counter() - save_start_time, queue_task.type.name)
+            trace.add_span('save', save_start_ns, time.time_ns(), parent_span,
+                           shape=list(img.shape), output_format=params.output_format)
+            return output
+
+        return file_utils.output_encode_executor.submit(save_output_timed)
+
+    def set_result_output(result: ImageGenerationResult, output):
+        if params.output_in_memory:
+            result.im_bytes, result.im_media_type = output
+        else:
+            result.im = output
+
+    def finish_queue_task():
+        trace.root.set_attribute('finish_with_error', queue_task.finish_with_error)
+        trace.end()
+        tracing.export_trace(trace)
+        task_queue.finish_task(queue_task.seq)
+
     def make_results_from_outputs():
         results: List[ImageGenerationResult] = []
         for item in outputs.outputs:
@@ -70,31 +217,31 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
             if item[0] == 'results':
                 for im in item[1]:
                     if isinstance(im, np.ndarray):
-                        img_filename = save_output_file(im)
-                        results.append(ImageGenerationResult(im=img_filename, seed=seed, finish_reason=GenerationFinishReason.success))
+                        result = ImageGenerationResult(im=None, seed=seed, finish_reason=GenerationFinishReason.success)
+                        set_result_output(result, save_output_async(im).result())
+                        results.append(result)
         queue_task.set_result(results, False)
-        task_queue.finish_task(queue_task.seq)
+        finish_queue_task()
         print(f"[Task Queue] Finish task, seq={queue_task.seq}")
         return results
 
     try:
-        waiting_sleep_steps: int = 0
         waiting_start_time = time.perf_counter()
-        while not task_queue.is_task_ready_to_start(queue_task.seq):
-            if waiting_sleep_steps == 0:
-                print(
-                    f"[Task Queue] Waiting for task queue become free, seq={queue_task.seq}")
-            delay = 0.1
-            time.sleep(delay)
-            waiting_sleep_steps += 1
-            if waiting_sleep_steps % int(10 / delay) == 0:
+        # Tasks from task_schedule_loop are already started, only direct callers need to wait
+        if queue_task.start_millis == 0 and not task_queue.is_task_ready_to_start(queue_task.seq):
+            print(f"[Task Queue] Waiting for task queue become free, seq={queue_task.seq}")
+            while not task_queue.wait_for_task_ready(queue_task.seq, timeout=10):
+                if queue_task.is_finished:
+                    return [] if queue_task.task_result is None else queue_task.task_result
                 waiting_time = time.perf_counter() - waiting_start_time
-                print(
-                    f"[Task Queue] Already waiting for {waiting_time}S, seq={queue_task.seq}")
+                print(f"[Task Queue] Already waiting for {waiting_time}S, seq={queue_task.seq}")
 
         print(f"[Task Queue] Task queue is free, start task, seq={queue_task.seq}")
 
         task_queue.start_task(queue_task.seq)
+        metrics.queue_wait_seconds.observe((queue_task.start_millis - queue_task.in_queue_millis) / 1000, queue_task.type.name)
+        trace.add_span('queue_wait', queue_task.in_queue_millis * 1000000, queue_task.start_millis * 1000000)
+        trace.start_stage('parameters')
 
         execution_start_time = time.perf_counter()
 
@@ -209,7 +356,9 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
             if (current_tab == 'inpaint' or (current_tab == 'ip' and advanced_parameters.mixing_image_prompt_and_inpaint))\
                     and isinstance(inpaint_input_image, dict):
                 inpaint_image = inpaint_input_image['image']
-                inpaint_mask = inpaint_input_image['mask'][:, :, 0]
+                inpaint_mask = inpaint_input_image['mask']
+                if inpaint_mask.ndim == 3:
+                    inpaint_mask = inpaint_mask[:, :, 0]
                 inpaint_image = HWC3(inpaint_image)
                 if isinstance(inpaint_image, np.ndarray) and isinstance(inpaint_mask, np.ndarray) \
                         and (np.any(inpaint_mask > 127) or len(outpaint_selections) > 0):
@@ -231,6 +380,8 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                     clip_vision_path, ip_negative_path, ip_adapter_path = path.downloading_ip_adapters()
                 progressbar(1, 'Loading control models ...')
 
+        trace.start_stage('model_refresh', base_model=base_model_name, refiner_model=refiner_model_name,
+                          lora_count=len([l for l in loras if l[0] != 'None']))
         # Load or unload CNs
         pipeline.refresh_controlnets([controlnet_canny_path, controlnet_cpds_path])
         ip_adapter.load_ip_adapter(clip_vision_path, ip_negative_path, ip_adapter_path)
@@ -271,8 +422,12 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
 
             progressbar(3, 'Loading models ...')
             pipeline.refresh_everything(refiner_model_name=refiner_model_name, base_model_name=base_model_name, loras=loras)
+            trace.stage.set_attribute('models_reloaded', pipeline.final_clip is not cond_cache_clip)
+            refresh_cond_cache(pipeline.final_clip)
+            cond_cache_models = (base_model_name, refiner_model_name, tuple(tuple(l) for l in loras))
 
             progressbar(3, 'Processing prompts ...')
+            trace.start_stage('styles', style_count=len(style_selections), image_number=image_number)
             tasks = []
             for i in range(image_number):
                 task_seed = (seed + i) % (constants.MAX_SEED + 1)  # randint is inclusive, % is not
@@ -318,20 +473,48 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                 ))
 
             if use_expansion:
+                expansion_hits = expansion_cache.hits
+                trace.start_stage('expansion')
                 for i, t in enumerate(tasks):
                     progressbar(5, f'Preparing Fooocus text #{i + 1} ...')
-                    expansion = pipeline.final_expansion(t['task_prompt'], t['task_seed'])
+                    expansion = final_expansion_cached(pipeline.final_expansion, t['task_prompt'], t['task_seed'])
                     print(f'[Prompt Expansion] {expansion}')
                     t['expansion'] = expansion
                     t['positive'] = copy.deepcopy(t['positive']) + [expansion]  # Deep copy.
+                trace.stage.set_attribute('cache_hits', expansion_cache.hits - expansion_hits)
+
+            trace.start_stage('clip_encode')
+            cond_hits = cond_cache.hits
+
+            # Tasks with identical workloads share the same encoded conditions, e.g. negative prompts
+            # without wildcards, so each unique workload is encoded only once
+            encoded_conds = {}
+
+            def clip_encode_once(texts, pool_top_k, progress, message):
+                key = (tuple(texts), pool_top_k)
+                if key not in encoded_conds:
+                    cache_key = (cond_cache_models, key)
+                    cond = cond_cache.get(cache_key)
+                    if cond is None:
+                        progressbar(progress, message)
+                        cond = pipeline.clip_encode(texts=texts, pool_top_k=pool_top_k)
+                        if cond is not None:
+                            cond_cache.put(cache_key, cond)
+                    encoded_conds[key] = cond
+                return encoded_conds[key]
 
             for i, t in enumerate(tasks):
-                progressbar(7, f'Encoding positive #{i + 1} ...')
-                t['c'] = pipeline.clip_encode(texts=t['positive'], pool_top_k=t['positive_top_k'])
+                t['c'] = clip_encode_once(t['positive'], t['positive_top_k'], 7, f'Encoding positive #{i + 1} ...')
 
             for i, t in enumerate(tasks):
-                progressbar(10, f'Encoding negative #{i + 1} ...')
-                t['uc'] = pipeline.clip_encode(texts=t['negative'], pool_top_k=t['negative_top_k'])
+                t['uc'] = clip_encode_once(t['negative'], t['negative_top_k'], 10, f'Encoding negative #{i + 1} ...')
+
+            print(f'[Prompt Encoding] Encoded {len(encoded_conds)} unique workloads for {len(tasks)} tasks, cache stats: {cond_cache.stats()}')
+            trace.stage.set_attribute('unique_workloads', len(encoded_conds))
+            trace.stage.set_attribute('cache_hits', cond_cache.hits - cond_hits)
+            if len(tasks) > 0 and tasks[0]['c'] is not None:
+                trace.stage.set_attribute('cond_shape', list(tasks[0]['c'][0][0].shape))
+            del encoded_conds
 
         if len(goals) > 0:
             progressbar(13, 'Image processing ...')
@@ -354,10 +537,12 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
 
             uov_input_image = set_image_shape_ceil(uov_input_image, shape_ceil)
 
+            trace.start_stage('vae_encode', goal='vary', image_shape=list(uov_input_image.shape))
             initial_pixels = core.numpy_to_pytorch(uov_input_image)
             progressbar(13, 'VAE encoding ...')
             initial_latent = core.encode_vae(vae=pipeline.final_vae, pixels=initial_pixels)
             B, C, H, W = initial_latent['samples'].shape
+            trace.stage.set_attribute('latent_shape', [B, C, H, W])
             width = W * 8
             height = H * 8
             print(f'Final resolution is {str((height, width))}.')
@@ -365,6 +550,7 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
         if 'upscale' in goals:
             H, W, C = uov_input_image.shape
             progressbar(13, f'Upscaling image from {str((H, W))} ...')
+            trace.start_stage('upscale', image_shape=[H, W, C])
 
             uov_input_image = core.numpy_to_pytorch(uov_input_image)
             uov_input_image = perform_upscale(uov_input_image)
@@ -413,6 +599,7 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
             if advanced_parameters.overwrite_upscale_strength > 0:
                 denoising_strength = advanced_parameters.overwrite_upscale_strength
 
+            trace.start_stage('vae_encode', goal='upscale', image_shape=list(uov_input_image.shape), tiled=True)
             initial_pixels = core.numpy_to_pytorch(uov_input_image)
             progressbar(13, 'VAE encoding ...')
 
@@ -420,12 +607,14 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                 vae=pipeline.final_vae if pipeline.final_refiner_vae is None else pipeline.final_refiner_vae,
                 pixels=initial_pixels, tiled=True)
             B, C, H, W = initial_latent['samples'].shape
+            trace.stage.set_attribute('latent_shape', [B, C, H, W])
             width = W * 8
             height = H * 8
             print(f'Final resolution is {str((height, width))}.')
             refiner_swap_method = 'upscale'
 
         if 'inpaint' in goals:
+            trace.start_stage('inpaint_prepare', outpaint=len(outpaint_selections) > 0)
             if len(outpaint_selections) > 0:
                 H, W, C = inpaint_image.shape
                 if 'top' in outpaint_selections:
@@ -461,6 +650,7 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                 return results
 
             progressbar(13, 'VAE Inpaint encoding ...')
+            trace.start_stage('vae_encode', goal='inpaint')
 
             inpaint_pixel_fill = core.numpy_to_pytorch(inpaint_worker.current_task.interested_fill)
             inpaint_pixel_image = core.numpy_to_pytorch(inpaint_worker.current_task.interested_image)
@@ -490,12 +680,14 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                                                     inpaint_head_model_path=inpaint_head_model_path)
 
             B, C, H, W = latent_fill.shape
+            trace.stage.set_attribute('latent_shape', [B, C, H, W])
             height, width = H * 8, W * 8
             final_height, final_width = inpaint_worker.current_task.image.shape[:2]
             initial_latent = {'samples': latent_fill}
             print(f'Final resolution is {str((final_height, final_width))}, latent is {str((height, width))}.')
 
         if 'cn' in goals:
+            trace.start_stage('controlnet_preprocess', **{f'{cn_type}_count': len(cn_tasks[cn_type]) for cn_type in cn_tasks})
             for task in cn_tasks[flags.cn_canny]:
                 cn_img, cn_stop, cn_weight = task
                 cn_img = resize_image(HWC3(cn_img), width=width, height=height)
@@ -542,15 +734,28 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                 advanced_parameters.freeu_s2
             )
 
+        trace.end_stage()
         results = []
+        # Output images are encoded and saved in background while next image or next task is generating
+        output_futures = []
         all_steps = steps * image_number
 
         preparation_time = time.perf_counter() - execution_start_time
         print(f'Preparation time: {preparation_time:.2f} seconds')
+        metrics.preparation_seconds.observe(preparation_time, queue_task.type.name)
+        # End time of the last sampling step, or start time of sampling
+        last_step_time = 0.
 
         outputs.append(['preview', (13, 'Moving model to GPU ...', None)])
 
         def callback(step, x0, x, total_steps, y):
+            nonlocal last_step_time
+            step_time = time.perf_counter()
+            metrics.sampling_step_seconds.observe(step_time - last_step_time, queue_task.type.name)
+            last_step_time = step_time
+            if queue_task.cancel_requested:
+                # Only stop this task, the global interrupt flag may stop next task
+                raise fcbh.model_management.InterruptProcessingException()
             done_steps = current_task_id * steps + step
             outputs.append(['preview', (
                 int(15.0 + 85.0 * float(done_steps) / float(all_steps)),
@@ -558,7 +763,13 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                 y)])
 
         for current_task_id, task in enumerate(tasks):
+            if queue_task.cancel_requested:
+                results.append(ImageGenerationResult(
+                    im=None, seed=task['task_seed'], finish_reason=GenerationFinishReason.user_cancel))
+                break
+
             execution_start_time = time.perf_counter()
+            trace.start_stage('generate', image_index=current_task_id, seed=task['task_seed'])
 
             try:
                 positive_cond, negative_cond = task['c'], task['uc']
@@ -573,6 +784,9 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                                 positive_cond, negative_cond,
                                 pipeline.loaded_ControlNets[cn_path], cn_img, cn_weight, 0, cn_stop)
 
+                diffusion_span = trace.add_span('diffusion', steps=steps, switch=switch, width=width, height=height,
+                                                sampler=sampler_name, scheduler=scheduler_name, denoise=denoising_strength)
+                last_step_time = time.perf_counter()
                 imgs = pipeline.process_diffusion(
                     positive_cond=positive_cond,
                     negative_cond=negative_cond,
@@ -590,13 +804,21 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                     cfg_scale=cfg_scale,
                     refiner_swap_method=refiner_swap_method
                 )
+                # VAE decoding follows the last sampling step in process_diffusion
+                vae_decode_time = time.perf_counter() - last_step_time
+                metrics.vae_decode_seconds.observe(vae_decode_time, queue_task.type.name)
+                diffusion_span.end()
+                trace.add_span('vae_decode', diffusion_span.end_ns - int(vae_decode_time * 1e9), diffusion_span.end_ns, diffusion_span,
+                               image_shape=list(imgs[0].shape) if len(imgs) > 0 else [])
 
                 del task['c'], task['uc'], positive_cond, negative_cond  # Save memory
 
                 if inpaint_worker.current_task is not None:
+                    post_process_span = trace.add_span('post_process')
                     imgs = [inpaint_worker.current_task.post_process(x) for x in imgs]
+                    post_process_span.end()
 
-                img_filenames = []
+                img_futures = []
                 for x in imgs:
                     d = [
                         ('Prompt', task['log_positive_prompt']),
@@ -618,15 +840,23 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                         if n != 'None':
                             d.append((f'LoRA [{n}] weight', w))
                     if save_log:
+                        log_span = trace.add_span('log')
                         log(x, d, single_line_number=3)
-                    img_filename = save_output_file(x)
-                    img_filenames.append(img_filename)
+                        log_span.end()
+                    img_futures.append(save_output_async(x))
                 
                 # Fooocus async_worker.py code end
 
-                results.append(ImageGenerationResult(
-                    im=img_filenames[0], seed=task['task_seed'], finish_reason=GenerationFinishReason.success))
+                result = ImageGenerationResult(
+                    im=None, seed=task['task_seed'], finish_reason=GenerationFinishReason.success)
+                results.append(result)
+                output_futures.append((result, img_futures[0]))
             except Exception as e:
+                if queue_task.cancel_requested:
+                    print(f"[Task Queue] Task canceled, seq={queue_task.seq}")
+                    results.append(ImageGenerationResult(
+                        im=None, seed=task['task_seed'], finish_reason=GenerationFinishReason.user_cancel))
+                    break
                 print('Process error:', e)
                 results.append(ImageGenerationResult(
                     im=None, seed=task['task_seed'], finish_reason=GenerationFinishReason.error))
@@ -634,19 +864,46 @@ def process_generate(queue_task: QueueTask, params: ImageGenerationParams) -> Li
                 break
 
             execution_time = time.perf_counter() - execution_start_time
-            print(f'Generating and saving time: {execution_time:.2f} seconds')
+            print(f'Generating time: {execution_time:.2f} seconds')
 
         pipeline.prepare_text_encoder(async_call=True)
 
-        if not queue_task.finish_with_error:
-            queue_task.set_result(results, False)
-        task_queue.finish_task(queue_task.seq)
-        print(f"[Task Queue] Finish task, seq={queue_task.seq}")
+        trace.start_stage('output_wait', image_count=len(output_futures))
+
+        def finish_outputs():
+            try:
+                for result, future in output_futures:
+                    try:
+                        set_result_output(result, future.result())
+                    except Exception as e:
+                        print('Save output file error:', e)
+                        result.finish_reason = GenerationFinishReason.error
+
+                if queue_task.cancel_requested:
+                    queue_task.set_result(results, True, canceled_message)
+                elif not queue_task.finish_with_error:
+                    queue_task.set_result(results, False)
+                finish_queue_task()
+                print(f"[Task Queue] Finish task, seq={queue_task.seq}")
+            except Exception as e:
+                print('Finish task error:', e)
+                if not queue_task.is_finished:
+                    queue_task.set_result([], True, str(e))
+                    finish_queue_task()
+
+        if not wait_outputs and len(output_futures) > 0:
+            # Output images are encoded in background while next task is sampling
+            task_queue.release_task(queue_task.seq)
+            call_when_all_done([future for _, future in output_futures], finish_outputs)
+        else:
+            finish_outputs()
         return results
     except Exception as e:
         print('Worker error:', e)
         if not queue_task.is_finished:
-            task_queue.finish_task(queue_task.seq)
             queue_task.set_result([], True, str(e))
+            finish_queue_task()
             print(f"[Task Queue] Finish task with error, seq={queue_task.seq}")
         return []
+    finally:
+        outputs.release()
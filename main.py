@@ -8,6 +8,7 @@ from importlib.util import find_spec
 
 from fooocus_api_version import version
 from fooocusapi.repositories_versions import fooocus_commit_hash
+from fooocusapi.startup_manifest import StartupManifest, StartupTimer, files_signature, repository_signature, requirements_signature
 
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
@@ -186,7 +187,10 @@ def is_installed(package):
     return spec is not None
 
 
-def download_models():
+def model_downloads() -> list:
+    """
+    URL, model dir and file name of model files downloaded on start
+    """
     vae_approx_filenames = [
         ('xlvaeapp.pth', 'https://huggingface.co/lllyasviel/misc/resolve/main/xlvaeapp.pth'),
         ('vaeapp_sd15.pth', 'https://huggingface.co/lllyasviel/misc/resolve/main/vaeapp_sd15.pt'),
@@ -194,38 +198,54 @@ def download_models():
         'https://huggingface.co/lllyasviel/misc/resolve/main/xl-to-v1_interposer-v3.1.safetensors')
     ]
 
-    from modules.model_loader import load_file_from_url
     from modules.config import path_checkpoints as modelfile_path, path_loras as lorafile_path,path_vae_approx as vae_approx_path,path_fooocus_expansion as fooocus_expansion_path, \
         checkpoint_downloads, path_embeddings as embeddings_path, embeddings_downloads, lora_downloads
 
+    downloads = []
     for file_name, url in checkpoint_downloads.items():
-        load_file_from_url(url=url, model_dir=modelfile_path, file_name=file_name)
+        downloads.append((url, modelfile_path, file_name))
     for file_name, url in embeddings_downloads.items():
-        load_file_from_url(url=url, model_dir=embeddings_path, file_name=file_name)
+        downloads.append((url, embeddings_path, file_name))
     for file_name, url in lora_downloads.items():
-        load_file_from_url(url=url, model_dir=lorafile_path, file_name=file_name)
+        downloads.append((url, lorafile_path, file_name))
     for file_name, url in vae_approx_filenames:
-        load_file_from_url(url=url, model_dir=vae_approx_path, file_name=file_name)
+        downloads.append((url, vae_approx_path, file_name))
+    downloads.append(('https://huggingface.co/lllyasviel/misc/resolve/main/fooocus_expansion.bin', fooocus_expansion_path, 'pytorch_model.bin'))
+    return downloads
+
 
-    load_file_from_url(
-        url='https://huggingface.co/lllyasviel/misc/resolve/main/fooocus_expansion.bin',
-        model_dir=fooocus_expansion_path,
-        file_name='pytorch_model.bin'
-    )
+def download_models(downloads: list):
+    from modules.model_loader import load_file_from_url
+
+    for url, model_dir, file_name in downloads:
+        load_file_from_url(url=url, model_dir=model_dir, file_name=file_name)
 
 
 def prepare_environments(args) -> bool:
+    timer = StartupTimer()
+    # Steps verified at last start are skipped when their signatures are unchanged
+    manifest = StartupManifest(args.startup_manifest) if args.startup_manifest is not None else None
+
     if not args.skip_pip:
         torch_index_url = os.environ.get('TORCH_INDEX_URL', "https://download.pytorch.org/whl/cu121")
         
         # Check if need pip install
         requirements_file = 'requirements.txt'
-        if not requirements_met(requirements_file):
-            run_pip(f"install -r \"{requirements_file}\"", "requirements")
+        with timer.stage('pip check'):
+            if manifest is not None and manifest.matches('requirements', requirements_signature(requirements_file)):
+                print("[Startup] Requirements unchanged, skip pip check")
+            else:
+                pip_succeeded = True
+                if not requirements_met(requirements_file):
+                    pip_succeeded = run_pip(f"install -r \"{requirements_file}\"", "requirements") is not None
 
-        if not is_installed("torch") or not is_installed("torchvision"):
-            print(f"torch_index_url: {torch_index_url}")
-            run_pip(f"install torch==2.0.1 torchvision==0.15.2 --extra-index-url {torch_index_url}", "torch")
+                if not is_installed("torch") or not is_installed("torchvision"):
+                    print(f"torch_index_url: {torch_index_url}")
+                    pip_succeeded = run_pip(f"install torch==2.0.1 torchvision==0.15.2 --extra-index-url {torch_index_url}", "torch") is not None and pip_succeeded
+
+                if manifest is not None:
+                    # Signature is taken after install, since installing changes site-packages
+                    manifest.update('requirements', requirements_signature(requirements_file) if pip_succeeded else None)
 
     skip_sync_repo = False
     if args.sync_repo is not None:
@@ -245,14 +265,73 @@ def prepare_environments(args) -> bool:
             exit(1)
 
     if not skip_sync_repo:
-        download_repositories()
+        with timer.stage('repository sync'):
+            if manifest is not None and manifest.matches('repository', repository_signature(repo_dir(fooocus_name), fooocus_commit_hash)):
+                print(f"[Startup] {fooocus_name} is checked out at {fooocus_commit_hash}, skip repository sync")
+            else:
+                download_repositories()
+                if manifest is not None:
+                    manifest.update('repository', repository_signature(repo_dir(fooocus_name), fooocus_commit_hash))
 
     import fooocusapi.worker as worker
+    if args.shared_queue_file is not None:
+        import socket
+        from fooocusapi.shared_queue import SharedTaskQueue
+        worker_id = None
+        if args.role != 'api':
+            # Jobs left running by same id are queued again on start, others are failed when their lease expired
+            worker_id = args.worker_id if args.worker_id is not None else f"{socket.gethostname()}-{os.getpid()}"
+        worker.task_queue = SharedTaskQueue(args.shared_queue_file, args.queue_size, args.queue_history, worker_id)
+        worker.task_schedule_enabled = args.role != 'api'
+    elif args.role != 'all':
+        print(f"Argument '--role {args.role}' requires '--shared-queue-file'")
+        exit(1)
     worker.task_queue.queue_size = args.queue_size
     worker.task_queue.history_size = args.queue_history
+    worker.task_queue.affinity_scheduling = args.affinity_scheduling
+    worker.task_queue.affinity_max_skips = args.affinity_max_skips
+    worker.task_queue.affinity_max_wait_millis = int(args.affinity_max_wait * 1000)
+    worker.task_queue.client_queue_size = args.client_queue_size
+    worker.task_queue.priority_aging_millis = int(args.priority_aging * 1000)
+    from fooocusapi.task_queue import TaskPriority
+    for config in args.priority_queue_size:
+        priority, size = config.split('=')
+        worker.task_queue.priority_queue_sizes[TaskPriority[priority.strip()]] = int(size)
+    for config in args.client_weight:
+        client_key, weight = config.rsplit('=', 1)
+        worker.task_queue.client_weights[client_key.strip()] = float(weight)
+    if args.job_store_file is not None and args.shared_queue_file is not None:
+        print("Ignore '--job-store-file' since jobs are persisted in '--shared-queue-file'")
+    elif args.job_store_file is not None:
+        from fooocusapi.job_store import SqliteJobStore, restore_jobs
+        restore_jobs(worker.task_queue, SqliteJobStore(args.job_store_file, args.queue_history))
+
+    if args.trace_file is not None:
+        import fooocusapi.tracing as tracing
+        tracing.trace_exporter = tracing.TraceFileExporter(args.trace_file)
 
     if args.disable_private_log:
         worker.save_log = False
+    worker.cond_cache.max_size = args.cond_cache_size
+    worker.cond_cache.max_bytes = args.cond_cache_mb * 1024 * 1024
+    worker.expansion_cache.max_size = args.expansion_cache_size
+    if args.expansion_cache_file is not None:
+        from fooocusapi.cache_utils import SqliteCache
+        worker.expansion_disk_cache = SqliteCache(args.expansion_cache_file, args.expansion_cache_file_size)
+
+    from concurrent.futures import ThreadPoolExecutor
+    import fooocusapi.file_utils as file_utils
+    file_utils.output_file_cache.max_size = args.output_cache_size
+    if not file_utils.is_output_format_supported(args.output_format):
+        print(f"Unsupported output format: {args.output_format}, acceptable values are {', '.join(file_utils.output_formats)}, and avif needs pillow-avif-plugin installed")
+        exit(1)
+    file_utils.default_output_format = args.output_format
+    file_utils.default_output_quality = args.output_quality
+    file_utils.png_compress_level = args.output_png_compress_level
+    # In memory outputs can not be passed between processes of shared job queue
+    file_utils.sync_output_in_memory = args.sync_output_in_memory and args.shared_queue_file is None
+    file_utils.output_encode_executor = ThreadPoolExecutor(max_workers=args.output_encode_threads, thread_name_prefix="output_encode_")
+    file_utils.output_dir_max_bytes = args.output_dir_max_mb * 1024 * 1024
 
     if args.base_url is None or len(args.base_url.strip()) == 0:
         host = args.host
@@ -280,7 +359,9 @@ def prepare_environments(args) -> bool:
 
         sys.argv.append('--preset')
         sys.argv.append(args.preset)
-    import modules.config as path
+
+    with timer.stage('load config'):
+        import modules.config as path
     import fooocusapi.parameters as parameters
     parameters.defualt_styles = path.default_styles
     parameters.default_base_model_name = path.default_base_model_name
@@ -295,12 +376,25 @@ def prepare_environments(args) -> bool:
 
     ini_cbh_args()
 
-    download_models()
+    with timer.stage('model check'):
+        downloads = model_downloads()
+        model_files = [os.path.join(model_dir, file_name) for _, model_dir, file_name in downloads]
+        if manifest is not None and manifest.matches('models', files_signature(model_files)):
+            print("[Startup] Model files unchanged, skip model download check")
+        else:
+            download_models(downloads)
+            if manifest is not None:
+                manifest.update('models', files_signature(model_files))
+
+    if manifest is not None:
+        manifest.save()
 
     if args.preload_pipeline:
         print("Preload pipeline")
-        import modules.default_pipeline as _
+        with timer.stage('preload pipeline'):
+            import modules.default_pipeline as _
 
+    timer.print_breakdown()
     return True
 
 def pre_setup(skip_sync_repo: bool=False, disable_private_log: bool=False, skip_pip=False, load_all_models: bool=False, preload_pipeline: bool=False, preset: str | None=None):
@@ -314,7 +408,32 @@ def pre_setup(skip_sync_repo: bool=False, disable_private_log: bool=False, skip_
         preload_pipeline = False
         queue_size = 3
         queue_history = 100
+        shared_queue_file = None
+        role = 'all'
+        worker_id = None
+        job_store_file = None
+        affinity_scheduling = False
+        affinity_max_skips = 3
+        affinity_max_wait = 60
+        priority_queue_size = []
+        client_queue_size = 0
+        priority_aging = 60
+        client_weight = []
+        output_cache_size = 16
+        output_format = 'png'
+        output_quality = 95
+        output_png_compress_level = 6
+        output_encode_threads = 2
+        sync_output_in_memory = False
+        output_dir_max_mb = 0
+        cond_cache_size = 256
+        cond_cache_mb = 512
+        expansion_cache_size = 1024
+        expansion_cache_file = None
+        expansion_cache_file_size = 100000
+        trace_file = None
         preset = None
+        startup_manifest = None
 
     print("[Pre Setup] Prepare environments")
 
@@ -362,7 +481,36 @@ if __name__ == "__main__":
     parser.add_argument("--preload-pipeline", default=False, action="store_true", help="Preload pipeline before start http server")
     parser.add_argument("--queue-size", type=int, default=3, help="Working queue size, default: 3, generation requests exceeding working queue size will return failure")
     parser.add_argument("--queue-history", type=int, default=100, help="Finished jobs reserve in memory size, default: 100")
+    parser.add_argument("--shared-queue-file", type=str, default=None, help="SQLite file on a local file system to share job queue between processes on one host, with '--role' to split API and GPU workers, default is not shared")
+    parser.add_argument("--role", type=str, default='all', choices=['all', 'api', 'worker'], help="Role of this process with '--shared-queue-file', 'api' only accepts requests, 'worker' only runs jobs, default: all")
+    parser.add_argument("--worker-id", type=str, default=None, help="Unique id of this worker process of shared job queue, jobs left running by same id are queued again on start, default is host name and process id")
+    parser.add_argument("--disable-request-coalescing", default=False, action="store_true", help="Disable attaching generation requests with same parameters and fixed seed to unfinished or recently finished job")
+    parser.add_argument("--result-cache-size", type=int, default=1000, help="Results of sync requests with fixed seed kept for same requests, 0 for disable, default: 1000")
+    parser.add_argument("--result-cache-file", type=str, default=None, help="SQLite file of result cache, default is 'result_cache.db' in outputs dir")
+    parser.add_argument("--result-cache-ttl", type=float, default=168, help="Max hours results are kept in result cache, 0 for no limit, default: 168")
+    parser.add_argument("--output-dir-max-mb", type=int, default=0, help="Delete oldest output files when output dir is larger than specified MB, default: 0 for no limit")
+    parser.add_argument("--job-store-file", type=str, default=None, help="SQLite file to persist queued and finished jobs across restarts, unfinished async jobs are queued again on start, default is not persisted")
+    parser.add_argument("--trace-file", type=str, default=None, help="Append span trace of pipeline stages of each job to file as OpenTelemetry OTLP JSON lines, default is not exported")
+    parser.add_argument("--affinity-scheduling", default=False, action="store_true", help="Start waiting jobs using same base model, refiner model and loras as the last job first, to reduce model reloading")
+    parser.add_argument("--affinity-max-skips", type=int, default=3, help="Max times a waiting job can be skipped by affinity scheduling, default: 3")
+    parser.add_argument("--affinity-max-wait", type=float, default=60, help="Max seconds a waiting job can be delayed by affinity scheduling, default: 60")
+    parser.add_argument("--priority-queue-size", type=str, default=[], action="append", help="Queue size limit of a job priority, in form of 'PRIORITY=SIZE', priority is 'high' for sync jobs and 'normal' for async jobs, can be used multiple times")
+    parser.add_argument("--client-queue-size", type=int, default=0, help="Queue size limit of each client, clients are identified by 'X-Client-Key' header or host, default: 0 for no limit")
+    parser.add_argument("--priority-aging", type=float, default=60, help="Waiting jobs are raised one priority every specified seconds, 0 for never, default: 60")
+    parser.add_argument("--client-weight", type=str, default=[], action="append", help="Weight of a client in fair scheduling, in form of 'CLIENT_KEY=WEIGHT', default weight is 1, can be used multiple times")
+    parser.add_argument("--output-cache-size", type=int, default=16, help="Recently generated image files kept in memory for responses, 0 for disable, default: 16")
+    parser.add_argument("--output-format", type=str, default='png', help="Default output image format, 'png', 'jpeg', 'webp' or 'avif', default: png")
+    parser.add_argument("--output-quality", type=int, default=95, help="Default output image quality for jpeg, webp and avif, default: 95")
+    parser.add_argument("--output-png-compress-level", type=int, default=6, choices=range(0, 10), metavar="[0-9]", help="Compress level of png output, lower is faster and bigger, default: 6")
+    parser.add_argument("--output-encode-threads", type=int, default=2, help="Threads for encoding and saving output images, default: 2")
+    parser.add_argument("--sync-output-in-memory", default=False, action="store_true", help="Keep output images of sync requests with 'Accept: image/png' or 'require_base64' in memory only, without writing files, their 'url' will be null")
+    parser.add_argument("--cond-cache-size", type=int, default=256, help="Encoded prompt conditions kept in memory for reuse across requests, 0 for disable, default: 256")
+    parser.add_argument("--cond-cache-mb", type=int, default=512, help="Max memory size in MB of cached prompt conditions, default: 512")
+    parser.add_argument("--expansion-cache-size", type=int, default=1024, help="Fooocus V2 prompt expansions kept in memory, 0 for disable, default: 1024")
+    parser.add_argument("--expansion-cache-file", type=str, default=None, help="SQLite file to persist Fooocus V2 prompt expansions across restarts, default is not persisted")
+    parser.add_argument("--expansion-cache-file-size", type=int, default=100000, help="Max Fooocus V2 prompt expansions kept in expansion cache file, default: 100000")
     parser.add_argument("--preset", type=str, default=None, help="Apply specified UI preset.")
+    parser.add_argument("--startup-manifest", type=str, default=None, help="JSON file of requirements, repository commit and model files verified at last start, unchanged steps are skipped without network access, default is not used")
 
 
     args = parser.parse_args()
@@ -370,6 +518,11 @@ if __name__ == "__main__":
     if prepare_environments(args):
         sys.argv = [sys.argv[0]]
 
-        # Start api server
-        from fooocusapi.api import start_app
-        start_app(args)
+        if args.role == 'worker':
+            # Only run jobs of shared job queue
+            import fooocusapi.worker as worker
+            worker.task_schedule_loop()
+        else:
+            # Start api server
+            from fooocusapi.api import start_app
+            start_app(args)
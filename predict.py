@@ -9,9 +9,8 @@ from cog import BasePredictor, Input, Path
 from fooocusapi.parameters import GenerationFinishReason, ImageGenerationParams, available_aspect_ratios, uov_methods, outpaint_expansions, defualt_styles, default_base_model_name, default_refiner_model_name, default_lora_name, default_refiner_switch, default_lora_weight, default_cfg_scale, default_prompt_negative
 from fooocusapi.task_queue import TaskType
 from fooocusapi.worker import process_generate, task_queue
-from fooocusapi.file_utils import output_dir
+from fooocusapi.file_utils import decode_input_image, decode_input_mask, output_dir
 import numpy as np
-from PIL import Image
 
 
 class Predictor(BasePredictor):
@@ -96,19 +95,16 @@ class Predictor(BasePredictor):
                 style_selections_arr.append(style)
 
         if uov_input_image is not None:
-            im = Image.open(str(uov_input_image))
-            uov_input_image = np.array(im)
+            uov_input_image = decode_input_image(str(uov_input_image))
 
         inpaint_input_image_dict = None
         if inpaint_input_image is not None:
-            im = Image.open(str(inpaint_input_image))
-            inpaint_input_image = np.array(im)
+            inpaint_input_image = decode_input_image(str(inpaint_input_image))
 
             if inpaint_input_mask is not None:
-                im = Image.open(str(inpaint_input_mask))
-                inpaint_input_mask = np.array(im)
+                inpaint_input_mask = decode_input_mask(str(inpaint_input_mask))
             else:
-                inpaint_input_mask = np.zeros(inpaint_input_image.shape)
+                inpaint_input_mask = np.zeros(inpaint_input_image.shape[:2], dtype=np.uint8)
 
             inpaint_input_image_dict = {
                 'image': inpaint_input_image,
@@ -127,8 +123,7 @@ class Predictor(BasePredictor):
         for config in image_prompt_config:
             cn_img, cn_stop, cn_weight, cn_type = config
             if cn_img is not None:
-                im = Image.open(str(cn_img))
-                cn_img = np.array(im)
+                cn_img = decode_input_image(str(cn_img))
                 if cn_stop is None:
                     cn_stop = flags.default_parameters[cn_type][0]
                 if cn_weight is None: